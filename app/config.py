@@ -1,26 +1,48 @@
 # app/config.py
 import os
 import re # For more robust comment removal
+from functools import lru_cache
+from typing import Dict, FrozenSet, Optional, Tuple
 from dotenv import load_dotenv
 
+_COMMENT_RE = re.compile(r'\s*#')
+
 # Determine project root first
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
+def _scan_project_root() -> Optional[FrozenSet[str]]:
+    """Names of the entries directly under PROJECT_ROOT, listed once; None if the directory can't be read."""
+    try:
+        with os.scandir(PROJECT_ROOT) as entries:
+            return frozenset(entry.name for entry in entries)
+    except OSError:
+        return None
+
+_PROJECT_ROOT_ENTRIES = _scan_project_root()
+
+@lru_cache(maxsize=None)
+def _path_exists(path: str) -> bool:
+    """os.path.exists, answered from the PROJECT_ROOT listing for top-level entries and memoized otherwise."""
+    if _PROJECT_ROOT_ENTRIES is not None and os.path.dirname(path) == PROJECT_ROOT:
+        return os.path.basename(path) in _PROJECT_ROOT_ENTRIES
+    return os.path.exists(path)
+
 # Load environment variables from .env file located in the project root
 dotenv_path = os.path.join(PROJECT_ROOT, '.env')
-if os.path.exists(dotenv_path):
+if _path_exists(dotenv_path):
     load_dotenv(dotenv_path)
 else:
     load_dotenv()
 
 
+@lru_cache(maxsize=256)
 def clean_env_value(value: str) -> str:
     """Cleans a value read from .env: strips whitespace, quotes, and comments."""
     if value is None:
         return None
     
     # 1. Remove inline comments (anything after #)
-    cleaned_value = re.split(r'\s*#', value, 1)[0]
+    cleaned_value = _COMMENT_RE.split(value, 1)[0]
     
     # 2. Strip leading/trailing whitespace
     cleaned_value = cleaned_value.strip()
@@ -32,45 +54,58 @@ def clean_env_value(value: str) -> str:
         
     return cleaned_value if cleaned_value else None # Return None if it becomes empty
 
+# Snapshot os.environ once (after .env is loaded) with every value already cleaned
+_ENV_CACHE = {name: clean_env_value(value) for name, value in os.environ.items()}
+
 # API Keys
-GEMINI_API_KEY = clean_env_value(os.getenv("GEMINI_API_KEY")) # Clean API key too, just in case
+GEMINI_API_KEY = _ENV_CACHE.get("GEMINI_API_KEY") # Clean API key too, just in case
 
 # --- Path Configuration ---
 DEFAULT_XLSX_FILENAME = "data/train_with_text.xlsx"
 DEFAULT_CHROMA_DB_DIRNAME = "chroma_db_store_default"
 DEFAULT_LOG_FILENAME = "logs/api_default.log"
+DEFAULT_EMBEDDING_CACHE_FILENAME = "embedding_cache/embeddings.sqlite3"
 
-# XLSX Path
-xlsx_file_path_env = clean_env_value(os.getenv("XLSX_FILE_PATH"))
-if xlsx_file_path_env and os.path.isabs(xlsx_file_path_env):
-    XLSX_FILE_PATH = xlsx_file_path_env
-else:
-    XLSX_FILE_PATH = os.path.join(PROJECT_ROOT, xlsx_file_path_env or DEFAULT_XLSX_FILENAME)
-
-# ChromaDB Path (This is the directory for ChromaDB)
-chroma_db_path_env = clean_env_value(os.getenv("CHROMA_DB_PATH"))
-if chroma_db_path_env and os.path.isabs(chroma_db_path_env):
-    CHROMA_DB_PATH = chroma_db_path_env
-elif chroma_db_path_env:
-    CHROMA_DB_PATH = os.path.join(PROJECT_ROOT, chroma_db_path_env)
-else:
-    CHROMA_DB_PATH = os.path.join(PROJECT_ROOT, DEFAULT_CHROMA_DB_DIRNAME)
+_PATH_CACHE: Dict[Tuple[Optional[str], str], str] = {}
 
-# Log File Path
-log_file_path_env = clean_env_value(os.getenv("LOG_FILE_PATH"))
-if log_file_path_env and os.path.isabs(log_file_path_env):
-    LOG_FILE_PATH = log_file_path_env
-else:
-    LOG_FILE_PATH = os.path.join(PROJECT_ROOT, log_file_path_env or DEFAULT_LOG_FILENAME)
+def _resolve(env_val: Optional[str], default: str) -> str:
+    """Resolves a configured path: absolute values pass through, relative ones are joined onto PROJECT_ROOT."""
+    key = (env_val, default)
+    resolved = _PATH_CACHE.get(key)
+    if resolved is None:
+        if env_val and os.path.isabs(env_val):
+            resolved = env_val
+        else:
+            resolved = os.path.join(PROJECT_ROOT, env_val or default)
+        _PATH_CACHE[key] = resolved
+    return resolved
+
+XLSX_FILE_PATH = _resolve(_ENV_CACHE.get("XLSX_FILE_PATH"), DEFAULT_XLSX_FILENAME)
+CHROMA_DB_PATH = _resolve(_ENV_CACHE.get("CHROMA_DB_PATH"), DEFAULT_CHROMA_DB_DIRNAME) # Directory for ChromaDB
+LOG_FILE_PATH = _resolve(_ENV_CACHE.get("LOG_FILE_PATH"), DEFAULT_LOG_FILENAME)
+EMBEDDING_CACHE_PATH = _resolve(_ENV_CACHE.get("EMBEDDING_CACHE_PATH"), DEFAULT_EMBEDDING_CACHE_FILENAME) # SQLite file
 
 
 # --- Other Configurations ---
-COLLECTION_NAME = clean_env_value(os.getenv("COLLECTION_NAME")) or "contracts_persistent_api_v1_default"
-EMBEDDING_MODEL_NAME = clean_env_value(os.getenv("EMBEDDING_MODEL_NAME")) or "models/text-embedding-004"
-GENERATIVE_MODEL_NAME = clean_env_value(os.getenv("GENERATIVE_MODEL_NAME")) or "gemini-1.5-flash-latest"
-LOG_LEVEL = (clean_env_value(os.getenv("LOG_LEVEL")) or "INFO").upper()
-TOP_K_RETRIEVAL = int(clean_env_value(os.getenv("TOP_K_RETRIEVAL")) or "3")
-EMBEDDING_BATCH_SIZE = int(clean_env_value(os.getenv("EMBEDDING_BATCH_SIZE")) or "50")
+COLLECTION_NAME = _ENV_CACHE.get("COLLECTION_NAME") or "contracts_persistent_api_v1_default"
+EMBEDDING_MODEL_NAME = _ENV_CACHE.get("EMBEDDING_MODEL_NAME") or "models/text-embedding-004"
+GENERATIVE_MODEL_NAME = _ENV_CACHE.get("GENERATIVE_MODEL_NAME") or "gemini-1.5-flash-latest"
+LOG_LEVEL = (_ENV_CACHE.get("LOG_LEVEL") or "INFO").upper()
+TOP_K_RETRIEVAL = int(_ENV_CACHE.get("TOP_K_RETRIEVAL") or "3")
+EMBEDDING_BATCH_SIZE = int(_ENV_CACHE.get("EMBEDDING_BATCH_SIZE") or "50")
+EMBEDDING_CACHE_ENABLED = (_ENV_CACHE.get("EMBEDDING_CACHE_ENABLED") or "true").lower() in ("1", "true", "yes")
+SEMANTIC_CACHE_SIZE = int(_ENV_CACHE.get("SEMANTIC_CACHE_SIZE") or "256") # Recent queries kept for similarity hits; 0 disables
+SEMANTIC_CACHE_THRESHOLD = float(_ENV_CACHE.get("SEMANTIC_CACHE_THRESHOLD") or "0.97") # Cosine similarity needed for a hit
+SEMANTIC_CACHE_TTL_SECONDS = float(_ENV_CACHE.get("SEMANTIC_CACHE_TTL_SECONDS") or "600")
+CHROMA_ADD_BATCH_SIZE = int(_ENV_CACHE.get("CHROMA_ADD_BATCH_SIZE") or "512") # Items per collection.add() during ingestion
+# HNSW index settings; Chroma fixes these when a collection is created, so they only apply to new collections
+HNSW_SPACE = (_ENV_CACHE.get("HNSW_SPACE") or "cosine").lower()
+HNSW_CONSTRUCTION_EF = int(_ENV_CACHE.get("HNSW_CONSTRUCTION_EF") or "200")
+HNSW_SEARCH_EF = int(_ENV_CACHE.get("HNSW_SEARCH_EF") or "64")
+HNSW_M = int(_ENV_CACHE.get("HNSW_M") or "32")
+EMBEDDING_DTYPE = (_ENV_CACHE.get("EMBEDDING_DTYPE") or "float32").lower() # "float16" halves in-process embedding memory
+EMBEDDING_MAX_WORKERS = int(_ENV_CACHE.get("EMBEDDING_MAX_WORKERS") or "8") # Concurrent embedding segment requests
+EMBEDDING_ASYNC_CONCURRENCY = int(_ENV_CACHE.get("EMBEDDING_ASYNC_CONCURRENCY") or "16") # In-flight requests during bulk ingestion
 
 
 def validate_config():
@@ -79,21 +114,38 @@ def validate_config():
         raise ValueError("GEMINI_API_KEY is not set or empty after cleaning. Please check your .env file.")
     if not CHROMA_DB_PATH or CHROMA_DB_PATH == PROJECT_ROOT or CHROMA_DB_PATH == os.path.abspath("."):
         raise ValueError(f"CHROMA_DB_PATH ('{CHROMA_DB_PATH}') is invalid. It must be a specific directory, not the project root or current directory, and not empty.")
-    if not os.path.exists(os.path.dirname(XLSX_FILE_PATH)):
+    if not _path_exists(os.path.dirname(XLSX_FILE_PATH)):
         print(f"WARNING: Directory for XLSX_FILE_PATH '{os.path.dirname(XLSX_FILE_PATH)}' does not exist. File: '{XLSX_FILE_PATH}'")
     if TOP_K_RETRIEVAL <= 0:
         raise ValueError("TOP_K_RETRIEVAL must be a positive integer.")
     if EMBEDDING_BATCH_SIZE <=0 or EMBEDDING_BATCH_SIZE > 100:
         raise ValueError("EMBEDDING_BATCH_SIZE must be between 1 and 100.")
+    if SEMANTIC_CACHE_SIZE < 0:
+        raise ValueError("SEMANTIC_CACHE_SIZE must be zero (disabled) or a positive integer.")
+    if not 0.0 < SEMANTIC_CACHE_THRESHOLD <= 1.0:
+        raise ValueError("SEMANTIC_CACHE_THRESHOLD must be in (0, 1].")
+    if CHROMA_ADD_BATCH_SIZE <= 0:
+        raise ValueError("CHROMA_ADD_BATCH_SIZE must be a positive integer.")
+    if HNSW_SPACE not in ("cosine", "l2", "ip"):
+        raise ValueError("HNSW_SPACE must be 'cosine', 'l2' or 'ip'.")
+    if HNSW_CONSTRUCTION_EF <= 0 or HNSW_SEARCH_EF <= 0 or HNSW_M <= 0:
+        raise ValueError("HNSW_CONSTRUCTION_EF, HNSW_SEARCH_EF and HNSW_M must be positive integers.")
+    if EMBEDDING_DTYPE not in ("float32", "float16"):
+        raise ValueError("EMBEDDING_DTYPE must be 'float32' or 'float16'.")
+    if EMBEDDING_MAX_WORKERS <= 0:
+        raise ValueError("EMBEDDING_MAX_WORKERS must be a positive integer.")
+    if EMBEDDING_ASYNC_CONCURRENCY <= 0:
+        raise ValueError("EMBEDDING_ASYNC_CONCURRENCY must be a positive integer.")
 
 try:
     validate_config()
-    print(f"--- Resolved Config Paths ---")
-    print(f"Project Root:     {PROJECT_ROOT}")
-    print(f"XLSX Path:        {XLSX_FILE_PATH}")
-    print(f"ChromaDB Path:    {CHROMA_DB_PATH}")
-    print(f"Log Path:         {LOG_FILE_PATH}")
-    print(f"-----------------------------")
+    if __debug__: # Stripped when running under `python -O`
+        print(f"--- Resolved Config Paths ---")
+        print(f"Project Root:     {PROJECT_ROOT}")
+        print(f"XLSX Path:        {XLSX_FILE_PATH}")
+        print(f"ChromaDB Path:    {CHROMA_DB_PATH}")
+        print(f"Log Path:         {LOG_FILE_PATH}")
+        print(f"-----------------------------")
 except ValueError as e:
     print(f"CONFIGURATION ERROR: {e}")
     # raise SystemExit(f"Configuration Error: {e}")
\ No newline at end of file
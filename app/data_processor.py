@@ -1,25 +1,63 @@
 # app/data_processor.py
+import hashlib
 import logging
 import re
-from typing import Optional, Dict, Any, List
+import string
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List, Set, Tuple
+
+try:
+    import orjson as _json # C/SIMD decoder, noticeably faster than stdlib json
+except ImportError: # orjson is optional; fall back to the stdlib decoder
+    import json as _json
 
 # Import from app package
 from . import config, utils # Relative imports
-from .llm_services import get_gemini_generation
+from .llm_services import build_generation_config, get_gemini_generation, SUPPORTS_RESPONSE_SCHEMA, SUPPORTS_SYSTEM_INSTRUCTION
 from .vector_db_manager import VectorDBManager # Relative import
 
 logger = logging.getLogger(__name__)
 
-def build_extraction_prompt(primary_text: str, retrieved_contexts: Optional[List[Dict[str, Any]]] = None) -> str:
-    """Constructs the prompt for the LLM to extract information."""
+# Precompiled pattern for the per-response cleanup in process_extracted_data
+_DIGITS_RE = re.compile(r"\d+")
 
-    prompt = f"""
-    Constructs a detailed and robust prompt for the LLM to extract specific contract information
-    and output it in a structured JSON format.
-    """
+class _NumericCharTable(dict):
+    """str.translate table keeping decimal digits and '.' and deleting everything else (same result as re.sub(r"[^\\d.]", "", s))."""
+    def __missing__(self, codepoint: int) -> Optional[int]:
+        kept = codepoint if codepoint == 46 or chr(codepoint).isdecimal() else None # 46 == ord('.')
+        self[codepoint] = kept
+        return kept
+
+_NUMERIC_CHARS_TABLE = _NumericCharTable()
+
+# Keys always present in the final extraction result, even if their value is None
+_EXPECTED_KEYS = ("agreement_value", "agreement_start_date", "agreement_end_date", "renewal_notice_days")
 
-    # --- Start of the Enhanced Prompt ---
-    prompt = f"""
+# LRU cache of RAG retrievals keyed by (collection, generation, text digest, k) so repeated inputs skip embed + search.
+# The manager's generation changes whenever the collection does, so entries from before a change are never served.
+_RAG_CACHE_MAX_SIZE = 512
+_RAG_CACHE: "OrderedDict[Tuple[str, int, str, int], List[Dict[str, Any]]]" = OrderedDict()
+_RAG_CACHE_LOCK = threading.Lock()
+
+# Output schema for JSON-constrained generation (OpenAPI subset understood by Gemini)
+_EXTRACTION_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "agreement_value": {"type": "number", "nullable": True},
+        "agreement_start_date": {"type": "string", "nullable": True},
+        "agreement_end_date": {"type": "string", "nullable": True},
+        "renewal_notice_days": {"type": "integer", "nullable": True},
+        "party_one": {"type": "string", "nullable": True},
+        "party_two": {"type": "string", "nullable": True},
+    },
+    "required": ["agreement_value", "agreement_start_date", "agreement_end_date", "renewal_notice_days", "party_one", "party_two"],
+}
+# Built once so each extraction reuses the same GenerationConfig
+_EXTRACTION_GENERATION_CONFIG = build_generation_config(_EXTRACTION_RESPONSE_SCHEMA)
+
+# --- Extraction prompt pieces (built once at import, assembled per request) ---
+_PROMPT_INSTRUCTIONS = """
 You are an AI assistant specialized in meticulously analyzing legal contract texts. Your primary goal is to extract specific pieces of information from the provided "Primary Contract Text" and structure this information into a precise JSON output.
 
 **Instructions for Extraction:**
@@ -62,43 +100,68 @@ You are an AI assistant specialized in meticulously analyzing legal contract tex
         *   Identify the second party to the agreement, typically the Lessee, Tenant, Resident, or Client. Look for phrases like "between [Party One] and [Party Two]" or "[Party Two] hereinafter called the 'LESSEE'".
         *   Extract the full name or company name as a string.
         *   Apply similar extraction logic as for `party_one`.
+"""
 
+# Only needed when the SDK can't enforce _EXTRACTION_RESPONSE_SCHEMA server-side
+_JSON_FORMAT_EXAMPLE = """
 **Required JSON Output Structure and Example:**
 
 ```json
-{{
+{
   "agreement_value": <number_or_null>,
   "agreement_start_date": "YYYY-MM-DD_or_null",
   "agreement_end_date": "YYYY-MM-DD_or_null",
   "renewal_notice_days": <integer_or_null>,
   "party_one": "String_Name",
   "party_two": "String_Name"
-}}
+}
+"""
 
+_PRIMARY_TEXT_BLOCK = """
 Primary Contract Text:
 ---
-{primary_text}
+$primary_text
 ---
 """
 
+# Static part of every extraction request. Sent as the model's system instruction when the SDK supports it,
+# so the per-request prompt holds only the dynamic text and the provider can cache the shared prefix.
+_SYSTEM_INSTRUCTION = _PROMPT_INSTRUCTIONS + ("" if SUPPORTS_RESPONSE_SCHEMA else _JSON_FORMAT_EXAMPLE)
+
+# Without system-instruction support the static part is sent inline, ahead of the primary text.
+# Only the primary text block is a template, so the instruction text can hold a literal "$".
+_INLINE_INSTRUCTIONS = "" if SUPPORTS_SYSTEM_INSTRUCTION else _SYSTEM_INSTRUCTION
+_PRIMARY_TEXT_TEMPLATE = string.Template(_PRIMARY_TEXT_BLOCK)
+
+_RAG_EXAMPLES_HEADER = "\nSimilar Contract Examples (for context only, extract information *only* from Primary Contract Text above):\n"
+_PROMPT_TAIL = "\nPlease extract the information from the 'Primary Contract Text' using the specified JSON format."
+
+def build_extraction_prompt(primary_text: str, retrieved_contexts: Optional[List[Dict[str, Any]]] = None) -> str:
+    """Constructs the prompt for the LLM to extract information."""
+    prompt_parts = [_INLINE_INSTRUCTIONS, _PRIMARY_TEXT_TEMPLATE.substitute(primary_text=primary_text)]
+
     if retrieved_contexts:
-        prompt += "\nSimilar Contract Examples (for context only, extract information *only* from Primary Contract Text above):\n"
-        for i, context in enumerate(retrieved_contexts):
+        prompt_parts.append(_RAG_EXAMPLES_HEADER)
+        seen_examples: Set[Tuple[str, str]] = set()
+        for context in retrieved_contexts:
             context_text_snippet = context.get('text', '')[:800] # Limit snippet length
             source_file = context.get('metadata', {}).get('file_name', 'N/A')
+            example_key = (source_file, context_text_snippet[:120])
+            if example_key in seen_examples: # Duplicate rows only add prompt tokens
+                continue
+            seen_examples.add(example_key)
             distance = context.get('distance')
             distance_str = f"{distance:.4f}" if distance is not None else "N/A"
-            prompt += f"\n--- Example {i+1} (Source: {source_file}, Distance: {distance_str}) ---\n"
-            prompt += f"{context_text_snippet}...\n"
-        prompt += "---\n"
+            prompt_parts.append(f"\n--- Example {len(seen_examples)} (Source: {source_file}, Distance: {distance_str}) ---\n{context_text_snippet}...\n")
+        prompt_parts.append("---\n")
 
-    prompt += "\nPlease extract the information from the 'Primary Contract Text' using the specified JSON format."
-    return prompt
+    prompt_parts.append(_PROMPT_TAIL)
+    return "".join(prompt_parts)
 
 def process_extracted_data(raw_data: Dict[str, Any]) -> Dict[str, Any]:
     """Cleans and standardizes the extracted data from LLM JSON output."""
     processed = {}
-    logger.debug(f"Processing raw extracted data: {raw_data}")
+    logger.debug("Processing raw extracted data: %s", raw_data)
 
     # Agreement Value
     val_str = raw_data.get("agreement_value")
@@ -109,7 +172,7 @@ def process_extracted_data(raw_data: Dict[str, Any]) -> Dict[str, Any]:
             try:
                 # Remove currency symbols (common ones), commas, and whitespace.
                 # Be careful not to remove decimal points if they are part of the number.
-                cleaned_val_str = re.sub(r"[^\d\.]", "", val_str) # Keep digits and decimal point
+                cleaned_val_str = val_str.translate(_NUMERIC_CHARS_TABLE) # Keep digits and decimal point
                 if cleaned_val_str: # If something remains after stripping non-numeric
                     if '.' in cleaned_val_str:
                         processed["agreement_value"] = float(cleaned_val_str)
@@ -141,7 +204,7 @@ def process_extracted_data(raw_data: Dict[str, Any]) -> Dict[str, Any]:
                 processed["renewal_notice_days"] = int(renewal_days_val)
             except ValueError:
                 # If direct fails, try to extract digits (e.g., from "15 days")
-                match = re.search(r'\d+', renewal_days_val)
+                match = _DIGITS_RE.search(renewal_days_val)
                 if match:
                     try:
                         processed["renewal_notice_days"] = int(match.group(0))
@@ -154,10 +217,56 @@ def process_extracted_data(raw_data: Dict[str, Any]) -> Dict[str, Any]:
     else: # Key was missing or explicitly null
         processed["renewal_notice_days"] = None
 
-    logger.debug(f"Finished processing data: {processed}")
+    logger.debug("Finished processing data: %s", processed)
     return processed
 
 
+def _rag_cache_key(collection_name: str, generation: int, input_text: str, k: int) -> Tuple[str, int, str, int]:
+    digest = hashlib.blake2b(input_text.encode("utf-8"), digest_size=16).hexdigest()
+    return (collection_name, generation, digest, k)
+
+def _retrieve_contexts(input_text: str, vector_db_manager: VectorDBManager, k: int) -> List[Dict[str, Any]]:
+    """Queries the vector DB for similar documents, serving repeated inputs from _RAG_CACHE."""
+    key = _rag_cache_key(vector_db_manager.collection_name, vector_db_manager.generation, input_text, k)
+    with _RAG_CACHE_LOCK:
+        cached = _RAG_CACHE.get(key)
+        if cached is not None:
+            _RAG_CACHE.move_to_end(key)
+            logger.info("RAG context served from cache.")
+            return cached
+
+    retrieved = vector_db_manager.query_documents(input_text, k=k)
+    if retrieved: # Don't cache misses; the DB may simply not be populated yet
+        with _RAG_CACHE_LOCK:
+            _RAG_CACHE[key] = retrieved
+            _RAG_CACHE.move_to_end(key)
+            while len(_RAG_CACHE) > _RAG_CACHE_MAX_SIZE:
+                _RAG_CACHE.popitem(last=False)
+    return retrieved
+
+def clear_rag_cache():
+    """Drops all cached RAG retrievals. Entries from an older generation are never served anyway; this frees their memory."""
+    with _RAG_CACHE_LOCK:
+        _RAG_CACHE.clear()
+
+
+def _parse_llm_json(llm_response_text: str) -> Optional[Dict[str, Any]]:
+    """Fast path: trim a Markdown code fence and decode directly (orjson if available); falls back to utils.robust_json_parser."""
+    stripped = llm_response_text.strip()
+    if stripped.startswith("```"):
+        body_start = stripped.find("\n") # Skip the opening fence line (e.g. ```json)
+        fence_end = stripped.rfind("```")
+        if body_start != -1 and fence_end > body_start:
+            stripped = stripped[body_start + 1:fence_end]
+    try:
+        parsed = _json.loads(stripped)
+        if isinstance(parsed, dict):
+            return parsed
+    except ValueError:
+        pass
+    return utils.robust_json_parser(llm_response_text)
+
+
 def extract_contract_details_from_text(
     input_text: str,
     vector_db_manager: VectorDBManager,
@@ -174,11 +283,12 @@ def extract_contract_details_from_text(
     retrieved_contexts = None
     if use_rag:
         logger.info("RAG enabled. Querying vector DB for similar documents...")
-        retrieved_contexts = vector_db_manager.query_documents(input_text, k=config.TOP_K_RETRIEVAL)
+        retrieved_contexts = _retrieve_contexts(input_text, vector_db_manager, k=config.TOP_K_RETRIEVAL)
         if retrieved_contexts:
             logger.info(f"Retrieved {len(retrieved_contexts)} documents for RAG context.")
-            for i, ctx in enumerate(retrieved_contexts):
-                logger.debug(f"RAG Context {i+1}: ID={ctx.get('id')}, Dist={ctx.get('distance', -1.0):.4f}, File={ctx.get('metadata', {}).get('file_name', 'N/A')}")
+            if logger.isEnabledFor(logging.DEBUG): # Skip formatting every context when DEBUG is off
+                for i, ctx in enumerate(retrieved_contexts):
+                    logger.debug(f"RAG Context {i+1}: ID={ctx.get('id')}, Dist={ctx.get('distance', -1.0):.4f}, File={ctx.get('metadata', {}).get('file_name', 'N/A')}")
         else:
             logger.info("No relevant documents found for RAG context.")
 
@@ -187,15 +297,20 @@ def extract_contract_details_from_text(
     # logger.debug(f"Generated LLM Prompt (length {len(prompt)}):\n{prompt[:1000]}...")
 
     logger.info("Sending request to Gemini for data extraction...")
-    llm_response_text = get_gemini_generation(prompt)
+    llm_response_text = get_gemini_generation(
+        prompt,
+        response_schema=_EXTRACTION_RESPONSE_SCHEMA,
+        generation_config=_EXTRACTION_GENERATION_CONFIG,
+        system_instruction=_SYSTEM_INSTRUCTION if SUPPORTS_SYSTEM_INSTRUCTION else None
+    )
 
     if not llm_response_text:
         logger.error("LLM did not return a response.")
         return None
 
-    logger.debug(f"LLM Raw Response:\n{llm_response_text}")
+    logger.debug("LLM Raw Response:\n%s", llm_response_text)
 
-    raw_extracted_data_dict = utils.robust_json_parser(llm_response_text)
+    raw_extracted_data_dict = _parse_llm_json(llm_response_text)
 
     if not raw_extracted_data_dict:
         logger.error("Failed to parse JSON from LLM response.")
@@ -204,11 +319,9 @@ def extract_contract_details_from_text(
 
     logger.info(f"Successfully parsed raw data from LLM: {raw_extracted_data_dict}")
     
-    # Ensure all expected keys are present in the processed dict, even if value is None
-    expected_keys = ["agreement_value", "agreement_start_date", "agreement_end_date", "renewal_notice_days"]
     processed_data = process_extracted_data(raw_extracted_data_dict)
     
-    final_data = {key: processed_data.get(key) for key in expected_keys}
+    final_data = {key: processed_data.get(key) for key in _EXPECTED_KEYS}
     logger.info(f"Processed and finalized extracted data: {final_data}")
     
     return final_data
\ No newline at end of file
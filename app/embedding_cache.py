@@ -0,0 +1,70 @@
+# app/embedding_cache.py
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from typing import Dict, List
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Stay under SQLite's default limit on bound parameters per statement
+_SQLITE_MAX_PARAMS = 500
+
+class SQLiteEmbeddingCache:
+    """
+    Persistent text -> embedding store so identical texts are only sent to the embedding API once.
+    Keys are sha256(model name + text); values are raw float32 bytes.
+    """
+    def __init__(self, db_file_path: str):
+        self.db_file_path = db_file_path
+        cache_dir = os.path.dirname(db_file_path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        # One shared connection; lookups come from worker threads, so serialize access with a lock
+        self._conn = sqlite3.connect(db_file_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (hash TEXT PRIMARY KEY, embedding BLOB NOT NULL)")
+            self._conn.commit()
+        logger.info(f"Embedding cache opened at: {db_file_path}")
+
+    @staticmethod
+    def _key(model_name: str, text: str) -> str:
+        return hashlib.sha256(f"{model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, model_name: str, texts: List[str]) -> Dict[str, np.ndarray]:
+        """Returns {text: float32 vector} for the texts that are cached."""
+        texts_by_key = {self._key(model_name, text): text for text in texts}
+        keys = list(texts_by_key)
+        found: Dict[str, np.ndarray] = {}
+        with self._lock:
+            for i in range(0, len(keys), _SQLITE_MAX_PARAMS):
+                key_chunk = keys[i:i + _SQLITE_MAX_PARAMS]
+                placeholders = ",".join("?" * len(key_chunk))
+                rows = self._conn.execute(f"SELECT hash, embedding FROM embeddings WHERE hash IN ({placeholders})", key_chunk)
+                for key, blob in rows:
+                    found[texts_by_key[key]] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def put_many(self, model_name: str, texts: List[str], embeddings: np.ndarray):
+        """Stores one row of `embeddings` per text; rows containing NaN (failed embeddings) are skipped."""
+        if not texts or embeddings.shape[1] == 0:
+            return
+        valid_rows = ~np.isnan(embeddings).any(axis=1)
+        rows = [
+            (self._key(model_name, text), embeddings[i].astype(np.float32).tobytes())
+            for i, text in enumerate(texts) if valid_rows[i]
+        ]
+        if not rows:
+            return
+        with self._lock:
+            self._conn.executemany("INSERT OR IGNORE INTO embeddings (hash, embedding) VALUES (?, ?)", rows)
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,13 +1,23 @@
 # app/llm_services.py
+import asyncio
+import inspect
 import logging
+import random
+import sqlite3
 import time
-from typing import List, Optional, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from typing import List, Optional, Dict, Any, Tuple
 
+import httpx
+import numpy as np
 import google.generativeai as genai
+from google.ai import generativelanguage as glm
 from google.api_core import exceptions as google_exceptions
 
 # Import config from the app package
 from . import config # Use relative import
+from .embedding_cache import SQLiteEmbeddingCache
 
 logger = logging.getLogger(__name__)
 
@@ -21,61 +31,383 @@ def _configure_gemini():
 
 _configure_gemini() # Configure on module load
 
-def get_gemini_embeddings_batch(texts: List[str], model_name: str = config.EMBEDDING_MODEL_NAME, retries: int = 3, delay: int = 5) -> List[Optional[List[float]]]:
-    if not texts:
-        return []
-    if not config.GEMINI_API_KEY:
-        logger.error("Cannot generate embeddings: GEMINI_API_KEY not set.")
-        return [None] * len(texts)
+_MAX_BACKOFF_SECONDS = 60
 
-    all_embeddings: List[Optional[List[float]]] = []
-    
+# JSON-constrained output needs a newer google-generativeai (response_mime_type >= 0.5, response_schema >= 0.6).
+# On older SDKs we keep relying on the prompt alone to request JSON.
+SUPPORTS_JSON_RESPONSE = hasattr(genai.types.GenerationConfig, 'response_mime_type')
+SUPPORTS_RESPONSE_SCHEMA = SUPPORTS_JSON_RESPONSE and hasattr(genai.types.GenerationConfig, 'response_schema')
+# Likewise, GenerativeModel(system_instruction=...) only exists from 0.5 onwards.
+SUPPORTS_SYSTEM_INSTRUCTION = 'system_instruction' in inspect.signature(genai.GenerativeModel).parameters
+
+# REST endpoint used by the async bulk-embedding path
+_GEMINI_API_BASE_URL = "https://generativelanguage.googleapis.com/v1beta"
+_RETRYABLE_STATUS_CODES = frozenset({429, 500, 503, 504})
+
+# Finish reasons that don't indicate a problem with the candidate; resolved once instead of per response
+# (the Candidate proto lives in google.ai.generativelanguage; genai.types doesn't re-export it)
+_OK_FINISH = frozenset({
+    None,
+    glm.Candidate.FinishReason.FINISH_REASON_UNSPECIFIED,
+    glm.Candidate.FinishReason.STOP,
+})
+
+# Streamed JSON generations that show no '{' within this many chunks are treated as prose and retried
+_STREAM_JSON_PROBE_CHUNKS = 4
+
+def _backoff_delay(attempt: int, delay: float, error: Optional[Exception] = None, retry_after: Optional[str] = None) -> float:
+    """Seconds to wait before retry `attempt + 1`: the server's Retry-After if given, else exponential backoff with jitter."""
+    if retry_after is None:
+        retry_after = getattr(error, 'retry_after', None)
+    if retry_after is not None:
+        try:
+            # Clamp like the exponential path so a huge server value can't park a worker thread or semaphore slot
+            return min(_MAX_BACKOFF_SECONDS, max(0.0, float(retry_after)))
+        except (TypeError, ValueError):
+            pass
+    return min(_MAX_BACKOFF_SECONDS, delay * (2 ** attempt)) + random.random()
+
+def _embed_one_segment(batch_texts_segment: List[str], model_name: str, retries: int, delay: int) -> List[Optional[List[float]]]:
+    """Embeds one EMBEDDING_BATCH_SIZE-sized segment, retrying only this segment on transient API errors."""
     for attempt in range(retries):
         try:
-            current_batch_embeddings_for_this_attempt = []
-            for i in range(0, len(texts), config.EMBEDDING_BATCH_SIZE):
-                batch_texts_segment = texts[i:i + config.EMBEDDING_BATCH_SIZE]
-                logger.debug(f"Embedding batch segment {i // config.EMBEDDING_BATCH_SIZE + 1}, size: {len(batch_texts_segment)}")
-                
-                result = genai.embed_content(
-                    model=model_name,
-                    content=batch_texts_segment,
-                    task_type="RETRIEVAL_DOCUMENT"
-                )
-                
-                if isinstance(result, dict) and 'embedding' in result and isinstance(result['embedding'], list):
-                    if result['embedding'] and isinstance(result['embedding'][0], list):
-                        current_batch_embeddings_for_this_attempt.extend(result['embedding'])
-                    else:
-                        logger.warning(f"Unexpected embedding structure in segment. Filling with Nones.")
-                        current_batch_embeddings_for_this_attempt.extend([None] * len(batch_texts_segment))
+            logger.debug("Embedding batch segment of size %d (attempt %d/%d)", len(batch_texts_segment), attempt + 1, retries)
+            result = genai.embed_content(
+                model=model_name,
+                content=batch_texts_segment,
+                task_type="RETRIEVAL_DOCUMENT"
+            )
+
+            if isinstance(result, dict) and 'embedding' in result and isinstance(result['embedding'], list):
+                if result['embedding'] and isinstance(result['embedding'][0], list):
+                    segment_embeddings = result['embedding']
                 else:
-                    logger.warning(f"No 'embedding' key or unexpected format for batch segment. Result: {str(result)[:200]}. Filling with Nones.")
-                    current_batch_embeddings_for_this_attempt.extend([None] * len(batch_texts_segment))
-            
-            all_embeddings = current_batch_embeddings_for_this_attempt
-            if len(all_embeddings) == len(texts):
-                return all_embeddings
+                    logger.warning(f"Unexpected embedding structure in segment. Filling with Nones.")
+                    return [None] * len(batch_texts_segment)
             else:
-                logger.error(f"Mismatch in embedding count. Expected {len(texts)}, got {len(all_embeddings)}. Attempt {attempt+1}")
-                if attempt == retries - 1: return [None] * len(texts)
-                time.sleep(delay); continue
+                logger.warning(f"No 'embedding' key or unexpected format for batch segment. Result: {str(result)[:200]}. Filling with Nones.")
+                return [None] * len(batch_texts_segment)
+
+            if len(segment_embeddings) == len(batch_texts_segment):
+                return segment_embeddings
+            logger.error(f"Mismatch in embedding count. Expected {len(batch_texts_segment)}, got {len(segment_embeddings)}. Attempt {attempt+1}")
+            if attempt == retries - 1: return [None] * len(batch_texts_segment)
+            time.sleep(_backoff_delay(attempt, delay))
 
         except (google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable, google_exceptions.DeadlineExceeded, google_exceptions.InternalServerError) as e:
-            logger.warning(f"Embeddings API error (attempt {attempt + 1}/{retries}): {e}. Retrying in {delay}s...")
             if attempt == retries - 1:
+                logger.warning(f"Embeddings API error (attempt {attempt + 1}/{retries}): {e}.")
                 logger.error(f"Failed to get embeddings after {retries} retries due to API errors.")
-                return [None] * len(texts)
-            time.sleep(delay)
+                return [None] * len(batch_texts_segment)
+            wait_seconds = _backoff_delay(attempt, delay, e)
+            logger.warning(f"Embeddings API error (attempt {attempt + 1}/{retries}): {e}. Retrying in {wait_seconds:.1f}s...")
+            time.sleep(wait_seconds)
         except Exception as e:
             logger.error(f"Unexpected error generating embeddings: {e}", exc_info=True)
-            return [None] * len(texts)
-    
+            return [None] * len(batch_texts_segment)
+
     logger.error("Failed to get embeddings after all retries (embedding loop).")
-    return [None] * len(texts)
+    return [None] * len(batch_texts_segment)
+
+
+def _failed_embeddings(n: int) -> np.ndarray:
+    """An (n, 0) array: every row counts as failed and no embedding dimension is known."""
+    return np.full((n, 0), np.nan, dtype=config.EMBEDDING_DTYPE)
+
+
+def valid_embedding_mask(embeddings: np.ndarray) -> np.ndarray:
+    """Boolean mask over rows of a get_gemini_embeddings_batch result; False marks texts whose embedding failed."""
+    if embeddings.shape[1] == 0:
+        return np.zeros(embeddings.shape[0], dtype=bool)
+    return ~np.isnan(embeddings).any(axis=1)
+
+
+def _dedupe_texts(texts: List[str]) -> Tuple[List[str], List[int]]:
+    """Distinct texts in first-seen order, plus for each input text the row of its distinct copy."""
+    unique_index: Dict[str, int] = {}
+    text_to_unique = [unique_index.setdefault(text, len(unique_index)) for text in texts]
+    if len(unique_index) < len(texts):
+        logger.debug("Embedding %d unique texts out of %d inputs", len(unique_index), len(texts))
+    return list(unique_index), text_to_unique
+
+
+def _split_segments(texts: List[str]) -> List[List[str]]:
+    return [texts[i:i + config.EMBEDDING_BATCH_SIZE] for i in range(0, len(texts), config.EMBEDDING_BATCH_SIZE)]
 
 
-def get_gemini_generation(prompt: str, model_name: str = config.GENERATIVE_MODEL_NAME, retries: int = 3, delay: int = 5) -> Optional[str]:
+def _pack_segments(segment_results: List[List[Optional[List[float]]]], num_texts: int) -> np.ndarray:
+    """Packs per-segment results into one float32 (num_texts, dim) array with NaN rows for failures."""
+    # A segment either succeeded as a whole or is all Nones, so copy successful segments in with one slice
+    # assignment each; failed segments keep their NaN rows.
+    embedding_dim = next((len(seg[0]) for seg in segment_results if seg and seg[0]), 0)
+    embeddings_array = np.full((num_texts, embedding_dim), np.nan, dtype=np.float32)
+    for segment_index, segment_embeddings in enumerate(segment_results):
+        if not segment_embeddings or segment_embeddings[0] is None:
+            continue
+        start = segment_index * config.EMBEDDING_BATCH_SIZE
+        try:
+            embeddings_array[start:start + len(segment_embeddings)] = segment_embeddings
+        except ValueError as e: # Ragged or wrong-dimension vectors in this segment
+            logger.warning(f"Discarding embedding segment {segment_index + 1} with unexpected shape: {e}")
+    return embeddings_array
+
+
+@lru_cache(maxsize=1)
+def _get_embedding_cache() -> Optional[SQLiteEmbeddingCache]:
+    """Opens the on-disk embedding cache on first use; None if disabled or it can't be opened."""
+    if not config.EMBEDDING_CACHE_ENABLED:
+        return None
+    try:
+        return SQLiteEmbeddingCache(config.EMBEDDING_CACHE_PATH)
+    except (OSError, sqlite3.Error) as e:
+        logger.warning(f"Embedding cache unavailable at '{config.EMBEDDING_CACHE_PATH}': {e}. Continuing without it.")
+        return None
+
+
+def _lookup_cached_embeddings(unique_texts: List[str], model_name: str) -> Tuple[Dict[int, np.ndarray], List[int]]:
+    """Splits unique_texts into cache hits ({position: vector}) and the positions that still need embedding."""
+    cache = _get_embedding_cache()
+    cached_by_text: Dict[str, np.ndarray] = {}
+    if cache:
+        try:
+            cached_by_text = cache.get_many(model_name, unique_texts)
+        except sqlite3.Error as e: # Locked/corrupt file or I/O error: treat every text as a miss
+            logger.warning(f"Could not read from embedding cache: {e}")
+    cached_rows: Dict[int, np.ndarray] = {}
+    miss_positions: List[int] = []
+    for position, text in enumerate(unique_texts):
+        vector = cached_by_text.get(text)
+        if vector is None:
+            miss_positions.append(position)
+        else:
+            cached_rows[position] = vector
+    if cached_rows:
+        logger.debug("Embedding cache: %d hits, %d misses", len(cached_rows), len(miss_positions))
+    return cached_rows, miss_positions
+
+
+def _merge_cached_embeddings(model_name: str, num_unique: int, cached_rows: Dict[int, np.ndarray], miss_texts: List[str], miss_positions: List[int], miss_array: np.ndarray) -> np.ndarray:
+    """Stores freshly embedded texts in the cache and combines them with the hits into one (num_unique, dim) array."""
+    cache = _get_embedding_cache()
+    if cache and miss_texts:
+        try:
+            cache.put_many(model_name, miss_texts, miss_array)
+        except sqlite3.Error as e:
+            logger.warning(f"Could not write to embedding cache: {e}")
+    if not cached_rows:
+        return miss_array
+
+    embedding_dim = max(miss_array.shape[1], len(next(iter(cached_rows.values()))))
+    unique_array = np.full((num_unique, embedding_dim), np.nan, dtype=np.float32)
+    unique_array[list(cached_rows)] = np.stack(list(cached_rows.values()))
+    if miss_positions and miss_array.shape[1] == embedding_dim:
+        unique_array[miss_positions] = miss_array
+    return unique_array
+
+
+def _finalize_embeddings(unique_array: np.ndarray, text_to_unique: List[int]) -> np.ndarray:
+    """Scatters the per-unique-text array back to one row per original input text."""
+    if unique_array.shape[0] < len(text_to_unique):
+        unique_array = unique_array[text_to_unique]
+    # Optional float16 storage halves embedding memory; NaN failure markers survive the cast
+    return unique_array.astype(config.EMBEDDING_DTYPE, copy=False)
+
+
+def get_gemini_embeddings_batch(texts: List[str], model_name: str = config.EMBEDDING_MODEL_NAME, retries: int = 3, delay: int = 5, client: Optional[httpx.Client] = None) -> np.ndarray:
+    """
+    Embeds `texts` and returns an array of shape (len(texts), dim) and dtype config.EMBEDDING_DTYPE, row i belonging to texts[i].
+    Rows that could not be embedded are NaN (use valid_embedding_mask); if nothing succeeded, dim is 0.
+    With `client` (see create_embedding_http_client) requests go over its pooled connections via REST instead of the SDK.
+    """
+    if not texts:
+        return _failed_embeddings(0)
+    if not config.GEMINI_API_KEY:
+        logger.error("Cannot generate embeddings: GEMINI_API_KEY not set.")
+        return _failed_embeddings(len(texts))
+
+    unique_texts, text_to_unique = _dedupe_texts(texts)
+    cached_rows, miss_positions = _lookup_cached_embeddings(unique_texts, model_name)
+    miss_texts = [unique_texts[i] for i in miss_positions]
+    segments = _split_segments(miss_texts)
+    if client is not None:
+        embed_segment = partial(_embed_one_segment_http, client, model_name=model_name, retries=retries, delay=delay)
+    else:
+        embed_segment = partial(_embed_one_segment, model_name=model_name, retries=retries, delay=delay)
+
+    # Each segment is a network round-trip, so overlap them across worker threads.
+    # executor.map preserves segment order, which keeps embeddings aligned with `texts`.
+    if len(segments) <= 1:
+        segment_results = [embed_segment(segment) for segment in segments]
+    else:
+        logger.debug("Embedding %d texts in %d segments with up to %d workers", len(miss_texts), len(segments), config.EMBEDDING_MAX_WORKERS)
+        with ThreadPoolExecutor(max_workers=min(config.EMBEDDING_MAX_WORKERS, len(segments))) as executor:
+            segment_results = list(executor.map(embed_segment, segments))
+
+    miss_array = _pack_segments(segment_results, len(miss_texts))
+    unique_array = _merge_cached_embeddings(model_name, len(unique_texts), cached_rows, miss_texts, miss_positions, miss_array)
+    return _finalize_embeddings(unique_array, text_to_unique)
+
+
+def create_embedding_http_client() -> httpx.Client:
+    """Pooled keep-alive HTTP/2 client for the REST embedding path; share one per process and close it on shutdown."""
+    # Without a key the embedding helpers return early, but the client must still be constructible so the app starts
+    return httpx.Client(
+        http2=True,
+        headers={"x-goog-api-key": config.GEMINI_API_KEY} if config.GEMINI_API_KEY else None,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+        timeout=30.0
+    )
+
+
+def _batch_embed_request(batch_texts_segment: List[str], model_name: str) -> Tuple[str, Dict[str, Any]]:
+    """URL and JSON body of a REST batchEmbedContents call for one segment."""
+    model_path = model_name if model_name.startswith("models/") else f"models/{model_name}"
+    request_body = {
+        "requests": [
+            {"model": model_path, "content": {"parts": [{"text": text}]}, "taskType": "RETRIEVAL_DOCUMENT"}
+            for text in batch_texts_segment
+        ]
+    }
+    return f"{_GEMINI_API_BASE_URL}/{model_path}:batchEmbedContents", request_body
+
+
+def _parse_batch_embed_response(response: httpx.Response, num_texts: int) -> Optional[List[Optional[List[float]]]]:
+    """Segment embeddings from a batchEmbedContents response (Nones on a hard error); None if the status is worth retrying."""
+    if response.status_code in _RETRYABLE_STATUS_CODES:
+        return None
+    if response.is_error:
+        logger.error(f"Embeddings API returned HTTP {response.status_code}: {response.text[:200]}")
+        return [None] * num_texts
+    try:
+        segment_embeddings = [item.get("values") for item in response.json().get("embeddings", [])]
+    except (ValueError, AttributeError, TypeError) as e: # Non-JSON body, or JSON of an unexpected shape
+        logger.warning(f"Could not read embeddings from response ({e}): {response.text[:200]}. Filling with Nones.")
+        return [None] * num_texts
+    if len(segment_embeddings) == num_texts and all(segment_embeddings):
+        return segment_embeddings
+    logger.warning(f"Unexpected embedding structure in segment (expected {num_texts} vectors, got {len(segment_embeddings)}). Filling with Nones.")
+    return [None] * num_texts
+
+
+def _embed_one_segment_http(client: httpx.Client, batch_texts_segment: List[str], model_name: str, retries: int, delay: int) -> List[Optional[List[float]]]:
+    """Sync REST counterpart of _embed_one_segment, reusing `client`'s pooled connections."""
+    url, request_body = _batch_embed_request(batch_texts_segment, model_name)
+    for attempt in range(retries):
+        try:
+            response = client.post(url, json=request_body)
+        except httpx.TransportError as e:
+            error_message, retry_after = str(e), None
+        except Exception as e: # Like _embed_one_segment: degrade to "no embedding" rather than fail the caller
+            logger.error(f"Unexpected error generating embeddings: {e}", exc_info=True)
+            return [None] * len(batch_texts_segment)
+        else:
+            segment_embeddings = _parse_batch_embed_response(response, len(batch_texts_segment))
+            if segment_embeddings is not None:
+                return segment_embeddings
+            error_message, retry_after = f"HTTP {response.status_code}", response.headers.get("Retry-After")
+
+        if attempt == retries - 1:
+            logger.error(f"Failed to get embeddings after {retries} retries due to API errors. Last error: {error_message}")
+            return [None] * len(batch_texts_segment)
+        wait_seconds = _backoff_delay(attempt, delay, retry_after=retry_after)
+        logger.warning(f"Embeddings API error (attempt {attempt + 1}/{retries}): {error_message}. Retrying in {wait_seconds:.1f}s...")
+        time.sleep(wait_seconds)
+
+    return [None] * len(batch_texts_segment)
+
+
+async def _embed_one_segment_async(client: httpx.AsyncClient, semaphore: asyncio.Semaphore, batch_texts_segment: List[str], model_name: str, retries: int, delay: int) -> List[Optional[List[float]]]:
+    """Async REST counterpart of _embed_one_segment: one batchEmbedContents call, gated by `semaphore`."""
+    url, request_body = _batch_embed_request(batch_texts_segment, model_name)
+    async with semaphore:
+        for attempt in range(retries):
+            try:
+                response = await client.post(url, json=request_body)
+            except httpx.TransportError as e:
+                error_message, retry_after = str(e), None
+            except Exception as e:
+                logger.error(f"Unexpected error generating embeddings: {e}", exc_info=True)
+                return [None] * len(batch_texts_segment)
+            else:
+                segment_embeddings = _parse_batch_embed_response(response, len(batch_texts_segment))
+                if segment_embeddings is not None:
+                    return segment_embeddings
+                error_message, retry_after = f"HTTP {response.status_code}", response.headers.get("Retry-After")
+
+            if attempt == retries - 1:
+                logger.error(f"Failed to get embeddings after {retries} retries due to API errors. Last error: {error_message}")
+                return [None] * len(batch_texts_segment)
+            wait_seconds = _backoff_delay(attempt, delay, retry_after=retry_after)
+            logger.warning(f"Embeddings API error (attempt {attempt + 1}/{retries}): {error_message}. Retrying in {wait_seconds:.1f}s...")
+            await asyncio.sleep(wait_seconds)
+
+    return [None] * len(batch_texts_segment)
+
+
+async def get_gemini_embeddings_batch_async(texts: List[str], model_name: str = config.EMBEDDING_MODEL_NAME, retries: int = 3, delay: int = 5) -> np.ndarray:
+    """
+    Async variant of get_gemini_embeddings_batch for bulk ingestion: calls the REST batchEmbedContents
+    endpoint over one HTTP/2 connection with up to config.EMBEDDING_ASYNC_CONCURRENCY segments in flight.
+    Returns the same array layout as get_gemini_embeddings_batch.
+    """
+    if not texts:
+        return _failed_embeddings(0)
+    if not config.GEMINI_API_KEY:
+        logger.error("Cannot generate embeddings: GEMINI_API_KEY not set.")
+        return _failed_embeddings(len(texts))
+
+    unique_texts, text_to_unique = _dedupe_texts(texts)
+    cached_rows, miss_positions = _lookup_cached_embeddings(unique_texts, model_name)
+    miss_texts = [unique_texts[i] for i in miss_positions]
+    segments = _split_segments(miss_texts)
+
+    segment_results: List[List[Optional[List[float]]]] = []
+    if segments:
+        semaphore = asyncio.Semaphore(config.EMBEDDING_ASYNC_CONCURRENCY)
+        logger.debug("Embedding %d texts in %d segments with up to %d concurrent requests", len(miss_texts), len(segments), config.EMBEDDING_ASYNC_CONCURRENCY)
+        async with httpx.AsyncClient(http2=True, headers={"x-goog-api-key": config.GEMINI_API_KEY}, timeout=60.0) as client:
+            segment_results = list(await asyncio.gather(*(
+                _embed_one_segment_async(client, semaphore, segment, model_name, retries, delay)
+                for segment in segments
+            )))
+
+    miss_array = _pack_segments(segment_results, len(miss_texts))
+    unique_array = _merge_cached_embeddings(model_name, len(unique_texts), cached_rows, miss_texts, miss_positions, miss_array)
+    return _finalize_embeddings(unique_array, text_to_unique)
+
+
+@lru_cache(maxsize=4)
+def _get_model(model_name: str, system_instruction: Optional[str] = None) -> genai.GenerativeModel:
+    """Returns a cached GenerativeModel so the client wrapper isn't rebuilt on every call."""
+    if system_instruction:
+        return genai.GenerativeModel(model_name, system_instruction=system_instruction)
+    return genai.GenerativeModel(model_name)
+
+
+def build_generation_config(response_schema: Optional[Dict[str, Any]] = None) -> genai.types.GenerationConfig:
+    """Low-temperature config; when a schema is given, asks for JSON output to the extent the SDK supports it."""
+    config_kwargs: Dict[str, Any] = {"temperature": 0.2} # Keep temperature low for factual JSON
+    if response_schema is not None and SUPPORTS_JSON_RESPONSE:
+        config_kwargs["response_mime_type"] = "application/json"
+        if SUPPORTS_RESPONSE_SCHEMA:
+            config_kwargs["response_schema"] = response_schema
+    return genai.types.GenerationConfig(**config_kwargs)
+
+# Shared config for schema-less calls; callers with a fixed schema build theirs once and pass it in
+_DEFAULT_GENERATION_CONFIG = build_generation_config()
+
+
+def _chunk_text(chunk: Any) -> str:
+    """Text of one streamed chunk; empty when the chunk carries no content parts (e.g. a final finish-reason chunk)."""
+    if not chunk.candidates:
+        return ""
+    content = chunk.candidates[0].content
+    if not content or not content.parts:
+        return ""
+    return "".join(part.text for part in content.parts)
+
+
+def get_gemini_generation(prompt: str, model_name: str = config.GENERATIVE_MODEL_NAME, retries: int = 3, delay: int = 5, response_schema: Optional[Dict[str, Any]] = None, system_instruction: Optional[str] = None, generation_config: Optional[genai.types.GenerationConfig] = None) -> Optional[str]:
     if not prompt:
         logger.warning("Empty prompt received for generation.")
         return None
@@ -83,37 +415,61 @@ def get_gemini_generation(prompt: str, model_name: str = config.GENERATIVE_MODEL
         logger.error("Cannot generate text: GEMINI_API_KEY not set.")
         return None
 
-    logger.debug(f"Attempting generation with model: {model_name}")
-    model = genai.GenerativeModel(model_name)
+    logger.debug("Attempting generation with model: %s", model_name)
+    if system_instruction and not SUPPORTS_SYSTEM_INSTRUCTION:
+        # Older SDK: fall back to sending the instruction inline ahead of the prompt
+        prompt = f"{system_instruction}\n{prompt}"
+        system_instruction = None
+    model = _get_model(model_name, system_instruction)
+    generation_config_obj = generation_config
+    if generation_config_obj is None:
+        generation_config_obj = build_generation_config(response_schema) if response_schema is not None else _DEFAULT_GENERATION_CONFIG
     
     for attempt in range(retries):
         try:
-            # For SDK < 0.4.0, we rely purely on the prompt to request JSON output.
-            # No special mime_type or request_options are supported for generate_content.
-            generation_config_obj = genai.types.GenerationConfig(
-                temperature=0.2, # Keep temperature low for factual JSON
-                # max_output_tokens=..., # Consider setting if concerned about long outputs
-                # top_p=...,
-                # top_k=...
-            )
-
             # The `generate_content` method in older SDKs typically takes the prompt
             # as the first argument, or via a `contents` keyword.
             # Let's ensure we're using the `contents` keyword for clarity and consistency.
+            # Streaming lets us inspect the start of the output before the full response arrives.
             response = model.generate_content(
                 contents=prompt, # Pass the prompt string to the 'contents' parameter
-                generation_config=generation_config_obj
-                # No other special parameters for JSON mode in this SDK version
+                generation_config=generation_config_obj,
+                stream=True
             )
-            
+
+            text_parts: List[str] = []
+            saw_json_start = response_schema is None # Only JSON requests are probed for an opening brace
+            probe_aborted = False
+            for chunk_index, chunk in enumerate(response):
+                chunk_text = _chunk_text(chunk)
+                if chunk_text:
+                    text_parts.append(chunk_text)
+                    if not saw_json_start and '{' in chunk_text:
+                        saw_json_start = True
+                if not saw_json_start and chunk_index + 1 >= _STREAM_JSON_PROBE_CHUNKS:
+                    probe_aborted = True
+                    break
+
+            if probe_aborted:
+                logger.warning(f"No JSON object in the first {_STREAM_JSON_PROBE_CHUNKS} streamed chunks (attempt {attempt + 1}/{retries}). Output starts: {''.join(text_parts)[:100]}")
+                if attempt == retries - 1:
+                    logger.error(f"Model {model_name} kept returning non-JSON output after {retries} attempts.")
+                    return None
+                continue
+
+            if text_parts:
+                generated_text = "".join(text_parts)
+                logger.debug("Successfully generated text (length %d). Snippet: %s", len(generated_text), generated_text[:100])
+                return generated_text
+
             if response.candidates:
                 candidate = response.candidates[0] # Get the first candidate
                 if candidate.content and candidate.content.parts:
                     generated_text = candidate.content.parts[0].text
-                    logger.debug(f"Successfully generated text (length {len(generated_text)}). Snippet: {generated_text[:100]}")
+                    logger.debug("Successfully generated text (length %d). Snippet: %s", len(generated_text), generated_text[:100])
                     return generated_text
                 # Check finish reason even if parts are empty/missing
-                elif candidate.finish_reason not in [None, genai.types.Candidate.FinishReason.FINISH_REASON_UNSPECIFIED, genai.types.Candidate.FinishReason.STOP]:
+                elif candidate.finish_reason not in _OK_FINISH:
                     logger.warning(f"Generation finished with reason: {candidate.finish_reason}. Content might be missing or incomplete.")
                     return None # No usable text
                 else: 
@@ -128,11 +484,13 @@ def get_gemini_generation(prompt: str, model_name: str = config.GENERATIVE_MODEL
                 return None
 
         except (google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable, google_exceptions.DeadlineExceeded, google_exceptions.InternalServerError) as e:
-            logger.warning(f"Generation API error (attempt {attempt + 1}/{retries}) with model {model_name}: {e}. Retrying in {delay}s...")
             if attempt == retries - 1:
+                logger.warning(f"Generation API error (attempt {attempt + 1}/{retries}) with model {model_name}: {e}.")
                 logger.error(f"Failed to generate text after {retries} retries for model {model_name}.")
                 return None
-            time.sleep(delay)
+            wait_seconds = _backoff_delay(attempt, delay, e)
+            logger.warning(f"Generation API error (attempt {attempt + 1}/{retries}) with model {model_name}: {e}. Retrying in {wait_seconds:.1f}s...")
+            time.sleep(wait_seconds)
         except Exception as e: # Catch any other unexpected errors
             logger.error(f"Unexpected error during generation with model {model_name}: {e}", exc_info=True)
             # For unexpected errors, it's often better to not retry endlessly.
@@ -1,18 +1,22 @@
 # app/main.py
+import asyncio
+import functools
 import logging
 import json
 import os
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, HTTPException, Body, Depends, status
+import anyio
+from fastapi import FastAPI, HTTPException, Body, Depends, BackgroundTasks, status
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field # Field for Pydantic model field customization
 from typing import Optional, Dict, Any
-# import pandas as pd # Not directly used in main.py anymore, but in vector_db_manager
+# import pandas as pd # Not used in main.py; vector_db_manager imports it lazily for ingestion
 
 # Import from app package
 from . import config, utils # Relative imports
 from .vector_db_manager import VectorDBManager
-from .data_processor import extract_contract_details_from_text
+from .data_processor import extract_contract_details_from_text, clear_rag_cache
 
 # Setup logging as early as possible
 utils.setup_logging() # This should be called once
@@ -48,14 +52,72 @@ class ExtractResponse(BaseModel):
     error: Optional[str] = None
 
 
+# --- Lightweight coercion for ExtractedDetails (used instead of full Pydantic validation) ---
+def _coerce_float(value: Any) -> Optional[float]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return None
+
+def _coerce_int(value: Any) -> Optional[int]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float):
+        return int(value) if value.is_integer() else None
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            return None
+    return None
+
+def _coerce_str(value: Any) -> Optional[str]:
+    return value if isinstance(value, str) else None
+
+_EXTRACTED_FIELD_COERCERS = {
+    "agreement_value": _coerce_float,
+    "agreement_start_date": _coerce_str,
+    "agreement_end_date": _coerce_str,
+    "renewal_notice_days": _coerce_int,
+    "party_one": _coerce_str,
+    "party_two": _coerce_str,
+}
+
+def _sanitize_extracted_details(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Coerces the ExtractedDetails fields to their declared types (None when a value doesn't fit) and drops unknown keys."""
+    return {field: coerce(data.get(field)) for field, coerce in _EXTRACTED_FIELD_COERCERS.items()}
+
+
 # --- Global Variables / Application State ---
 db_manager_instance: Optional[VectorDBManager] = None
+startup_population_task: Optional[asyncio.Task] = None
+_populated = False # True once startup population has finished (or wasn't needed); RAG requests wait for it
+_STARTUP_POPULATION_SHUTDOWN_TIMEOUT = 30.0 # Seconds shutdown waits for an unfinished startup population
+
+async def _populate_on_startup(db_manager: VectorDBManager):
+    """Runs the initial XLSX population in a worker thread so the server can answer /health meanwhile."""
+    global _populated
+    try:
+        await asyncio.to_thread(db_manager.populate_from_xlsx, config.XLSX_FILE_PATH, False) # Don't force if just checking
+        logger.info(f"Initial DB population complete. New count: {db_manager.get_collection_count()}")
+    except Exception as e:
+        logger.error(f"Error during initial DB population on startup: {e}", exc_info=True)
+    finally:
+        _populated = True # Even on failure: serve with whatever the DB holds rather than stay unready
 
 # --- FastAPI Lifespan Events ---
 @asynccontextmanager
 async def lifespan(app_instance: FastAPI): # Renamed 'app' to 'app_instance' to avoid conflict
     # Startup
-    global db_manager_instance
+    global db_manager_instance, startup_population_task, _populated
     logger.info("FastAPI application startup...")
     try:
         # Config validation is now done when config.py is imported.
@@ -72,14 +134,12 @@ async def lifespan(app_instance: FastAPI): # Renamed 'app' to 'app_instance' to
         # This can be slow, consider if it's truly needed for your use case
         xlsx_exists = os.path.exists(config.XLSX_FILE_PATH)
         if db_manager_instance.get_collection_count() == 0 and xlsx_exists:
-            logger.info(f"Persistent DB is empty and '{config.XLSX_FILE_PATH}' exists. Attempting initial population...")
-            try:
-                db_manager_instance.populate_from_xlsx(xlsx_path=config.XLSX_FILE_PATH, force_repopulate=False) # Don't force if just checking
-                logger.info(f"Initial DB population complete. New count: {db_manager_instance.get_collection_count()}")
-            except Exception as e:
-                logger.error(f"Error during initial DB population on startup: {e}", exc_info=True)
-        elif not xlsx_exists and db_manager_instance.get_collection_count() == 0:
-            logger.warning(f"XLSX file for initial population not found at '{config.XLSX_FILE_PATH}'. DB remains empty.")
+            logger.info(f"Persistent DB is empty and '{config.XLSX_FILE_PATH}' exists. Starting initial population in the background...")
+            startup_population_task = asyncio.create_task(_populate_on_startup(db_manager_instance))
+        else:
+            if not xlsx_exists and db_manager_instance.get_collection_count() == 0:
+                logger.warning(f"XLSX file for initial population not found at '{config.XLSX_FILE_PATH}'. DB remains empty.")
+            _populated = True
 
 
     except Exception as e:
@@ -90,6 +150,16 @@ async def lifespan(app_instance: FastAPI): # Renamed 'app' to 'app_instance' to
     
     # Shutdown
     logger.info("FastAPI application shutdown...")
+    if startup_population_task is not None and not startup_population_task.done():
+        logger.warning("Initial DB population is still running; waiting for it to finish before shutdown.")
+        try:
+            # shield: on timeout, don't cancel while the worker thread may be mid-write
+            await asyncio.wait_for(asyncio.shield(startup_population_task), timeout=_STARTUP_POPULATION_SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error(f"Initial DB population did not finish within {_STARTUP_POPULATION_SHUTDOWN_TIMEOUT}s; shutting down without it.")
+            startup_population_task.cancel()
+    if db_manager_instance is not None:
+        db_manager_instance.close()
 
 
 # --- FastAPI App Instance ---
@@ -97,7 +167,8 @@ app = FastAPI(
     title="Contract Data Extractor API",
     description="API to extract structured data from contract texts using RAG with Gemini and ChromaDB.",
     version="1.0.1", # Updated version
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse # orjson's C serializer instead of stdlib json
 )
 
 # --- Dependency for DB Manager ---
@@ -113,18 +184,36 @@ def get_db_manager() -> VectorDBManager:
 
 
 # --- API Endpoints ---
-@app.post("/admin/populate-database", response_model=PopulateDBResponse, status_code=status.HTTP_200_OK, tags=["Admin & Maintenance"])
+def _populate_and_refresh_cache(db_manager: VectorDBManager, xlsx_path: str, force_repopulate: bool):
+    """Background job for the admin populate endpoint."""
+    try:
+        db_manager.populate_from_xlsx(xlsx_path=xlsx_path, force_repopulate=force_repopulate)
+        clear_rag_cache() # Entries keyed on the old generation can no longer hit; free them
+        logger.info(f"Background DB population from '{xlsx_path}' finished. Collection '{db_manager.collection_name}' now has {db_manager.get_collection_count()} items.")
+    except Exception as e:
+        logger.error(f"Error during background DB population: {e}", exc_info=True)
+
+
+@app.post("/admin/populate-database", response_model=PopulateDBResponse, status_code=status.HTTP_202_ACCEPTED, tags=["Admin & Maintenance"])
 async def populate_database_endpoint(
     request_body: PopulateDBRequest,
+    background_tasks: BackgroundTasks,
     db_manager: VectorDBManager = Depends(get_db_manager)
 ):
     """
     Populates the persistent vector database from contract texts in an XLSX file.
-    Can be a long-running operation. Use with caution in production.
+    Population runs as a background task; the response reports the item count at the time of the request.
     """
     effective_xlsx_path = request_body.xlsx_file_path or config.XLSX_FILE_PATH
     logger.info(f"Received admin request to populate DB from: {effective_xlsx_path}. Force: {request_body.force_repopulate}")
 
+    if not _populated or db_manager.is_populating:
+        logger.warning("Rejecting populate request: a database population is already in progress.")
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="A database population is already in progress. Retry once it has finished."
+        )
+
     if not os.path.exists(effective_xlsx_path):
         logger.error(f"XLSX file not found at: {effective_xlsx_path}")
         raise HTTPException(
@@ -133,17 +222,16 @@ async def populate_database_endpoint(
         )
 
     try:
-        # Consider running this in a background task for non-blocking API
-        # from fastapi import BackgroundTasks (and add BackgroundTasks to endpoint params)
-        # background_tasks.add_task(db_manager.populate_from_xlsx, xlsx_path=effective_xlsx_path, force_repopulate=request_body.force_repopulate)
-        # For now, synchronous:
-        db_manager.populate_from_xlsx(
-            xlsx_path=effective_xlsx_path,
-            force_repopulate=request_body.force_repopulate
+        # Runs in Starlette's threadpool after the response is sent, so the event loop isn't blocked
+        background_tasks.add_task(
+            _populate_and_refresh_cache,
+            db_manager,
+            effective_xlsx_path,
+            request_body.force_repopulate
         )
-        item_count = db_manager.get_collection_count()
-        msg = f"Database population from '{os.path.basename(effective_xlsx_path)}' {'forced and ' if request_body.force_repopulate else ''}completed."
-        logger.info(f"{msg} Collection '{db_manager.collection_name}' now has {item_count} items.")
+        item_count = await anyio.to_thread.run_sync(db_manager.get_collection_count)
+        msg = f"Database population from '{os.path.basename(effective_xlsx_path)}' {'(forced) ' if request_body.force_repopulate else ''}started in the background."
+        logger.info(f"{msg} Collection '{db_manager.collection_name}' currently has {item_count} items.")
         return PopulateDBResponse(
             message=msg,
             collection_name=db_manager.collection_name,
@@ -156,7 +244,9 @@ async def populate_database_endpoint(
             detail=f"Error during DB population: {str(e)}"
         )
 
-@app.post("/extract", response_model=ExtractResponse, tags=["Core Extraction"])
+# No response_model: the payload is built from our own parsed LLM output, so skip FastAPI's re-validation.
+# ExtractResponse is still declared for the OpenAPI schema.
+@app.post("/extract", responses={status.HTTP_200_OK: {"model": ExtractResponse}}, tags=["Core Extraction"])
 async def extract_details_endpoint(
     request_body: ExtractRequest,
     db_manager: VectorDBManager = Depends(get_db_manager)
@@ -167,35 +257,46 @@ async def extract_details_endpoint(
     logger.info(f"Received extraction request. RAG requested: {request_body.use_rag}")
     
     use_rag_effective = request_body.use_rag
-    if use_rag_effective and db_manager.get_collection_count() == 0:
+    if use_rag_effective and not _populated:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="The vector database is still being populated. Retry shortly, or set use_rag to false.",
+            headers={"Retry-After": "30"}
+        )
+    # has_data re-queries Chroma while the store is empty, so keep that call off the event loop too
+    if use_rag_effective and not await anyio.to_thread.run_sync(lambda: db_manager.has_data):
         logger.warning("RAG is enabled by request, but the vector database is empty. RAG context will be unavailable.")
         # The response will reflect that RAG was enabled but might not have found context.
 
     try:
-        extracted_data_dict = extract_contract_details_from_text(
+        # Embedding + Gemini calls block, so run them in a worker thread to keep the event loop free
+        extracted_data_dict = await anyio.to_thread.run_sync(functools.partial(
+            extract_contract_details_from_text,
             input_text=request_body.contract_text,
             vector_db_manager=db_manager,
             use_rag=use_rag_effective # Pass the effective RAG status
-        )
+        ))
 
         if extracted_data_dict:
-            parsed_details = ExtractedDetails(**extracted_data_dict)
+            # Fields are type-checked by the sanitizer, so construct without Pydantic's per-field validation
+            parsed_details = ExtractedDetails.model_construct(**_sanitize_extracted_details(extracted_data_dict))
             logger.info(f"Extraction successful. Data: {parsed_details.model_dump_json(indent=2)}")
-            return ExtractResponse(
+            return ORJSONResponse(content=ExtractResponse.model_construct(
                 message="Contract details extracted successfully.",
                 source_text_snippet=request_body.contract_text[:200] + "...",
                 extracted_data=parsed_details,
-                rag_enabled=use_rag_effective
-            )
+                rag_enabled=use_rag_effective,
+                error=None
+            ).model_dump())
         else:
             logger.warning("Extraction process completed but returned no structured data from LLM or parsing failed.")
-            return ExtractResponse(
+            return ORJSONResponse(content=ExtractResponse.model_construct(
                 message="Failed to extract structured details. LLM might not have found information or parsing failed.",
                 source_text_snippet=request_body.contract_text[:200] + "...",
                 extracted_data=None,
                 rag_enabled=use_rag_effective,
                 error="No structured data could be extracted or parsed from LLM response."
-            )
+            ).model_dump())
 
     except HTTPException: # Re-raise HTTPExceptions from called functions
         raise
@@ -210,7 +311,9 @@ async def extract_details_endpoint(
 async def health_check():
     """Simple health check endpoint."""
     # Could add checks for DB connection or LLM API key presence here
-    return {"status": "healthy", "message": "API is operational."}
+    if not _populated:
+        return {"status": "starting", "message": "API is operational; initial DB population is in progress.", "db_ready": False}
+    return {"status": "healthy", "message": "API is operational.", "db_ready": True}
 
 @app.get("/system/db-status", response_model=Dict[str, Any], tags=["System & Health"])
 async def database_status(db_manager: VectorDBManager = Depends(get_db_manager)):
@@ -219,18 +322,22 @@ async def database_status(db_manager: VectorDBManager = Depends(get_db_manager))
         "db_type": "ChromaDB (Persistent)",
         "db_path": db_manager.db_path,
         "collection_name": db_manager.collection_name,
-        "item_count": db_manager.get_collection_count(),
+        "item_count": await anyio.to_thread.run_sync(db_manager.get_collection_count),
         "is_healthy": True # Basic check, could be more sophisticated
     }
 
 # --- To run the app (for local development) ---
 if __name__ == "__main__":
+    import importlib.util
     import uvicorn
     logger.info("Starting Uvicorn server for local development from main.py...")
+    # uvloop/httptools come with uvicorn[standard]; uvloop isn't available on Windows, so fall back there
     uvicorn.run(
         "app.main:app", # Path to the FastAPI app instance
         host="0.0.0.0",
         port=8000,
+        loop="uvloop" if importlib.util.find_spec("uvloop") else "asyncio",
+        http="httptools" if importlib.util.find_spec("httptools") else "h11",
         log_level="info", # Uvicorn's own log level
         reload=True # Enable auto-reload for development
     )
\ No newline at end of file
@@ -0,0 +1,75 @@
+# app/semantic_cache.py
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+class SemanticQueryCache:
+    """
+    In-process cache of recent query embeddings -> retrieved documents.
+    A lookup hits when a cached query's cosine similarity to the new one is >= threshold, which lets
+    near-duplicate queries skip the Chroma search. Brute-force inner product over at most `capacity`
+    normalized vectors (the same search a flat IP index does), with LRU eviction and a TTL.
+    """
+    def __init__(self, capacity: int, threshold: float, ttl_seconds: float):
+        self.capacity = capacity
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._vectors: Optional[np.ndarray] = None # (capacity, dim), allocated on first put
+            self._results: List[Optional[List[Dict[str, Any]]]] = [None] * self.capacity
+            self._ks = np.zeros(self.capacity, dtype=np.int64)
+            self._generations = np.zeros(self.capacity, dtype=np.int64) # Collection generation each entry was read at
+            self._expires_at = np.zeros(self.capacity, dtype=np.float64) # 0 marks an empty slot
+            self._last_used = np.zeros(self.capacity, dtype=np.float64)
+
+    @staticmethod
+    def _normalize(embedding: np.ndarray) -> Optional[np.ndarray]:
+        vector = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else None
+
+    def lookup(self, query_embedding: np.ndarray, k: int, generation: int = 0) -> Optional[List[Dict[str, Any]]]:
+        """Cached results for a similar query retrieved with at least `k` results at `generation`, else None."""
+        query = self._normalize(query_embedding)
+        with self._lock:
+            if query is None or self._vectors is None or self._vectors.shape[1] != query.shape[0]:
+                return None
+            now = time.monotonic()
+            similarities = self._vectors @ query
+            # Ignore empty/expired slots, entries fetched with a smaller k than requested, and entries from another generation
+            similarities[(self._expires_at <= now) | (self._ks < k) | (self._generations != generation)] = -np.inf
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                return None
+            self._last_used[best] = now
+            logger.debug("Semantic query cache hit (similarity %.4f)", similarities[best])
+            return self._results[best][:k]
+
+    def put(self, query_embedding: np.ndarray, k: int, results: List[Dict[str, Any]], generation: int = 0):
+        """Caches `results`, tagged with the collection generation they were read at so a put racing a clear can't hit later."""
+        query = self._normalize(query_embedding)
+        if query is None:
+            return
+        with self._lock:
+            if self._vectors is None or self._vectors.shape[1] != query.shape[0]:
+                self._vectors = np.zeros((self.capacity, query.shape[0]), dtype=np.float32)
+                self._expires_at[:] = 0
+            now = time.monotonic()
+            # Reuse an empty or expired slot if there is one, otherwise evict the least recently used
+            free_slots = np.flatnonzero(self._expires_at <= now)
+            slot = int(free_slots[0]) if free_slots.size else int(np.argmin(self._last_used))
+            self._vectors[slot] = query
+            self._results[slot] = results
+            self._ks[slot] = k
+            self._generations[slot] = generation
+            self._expires_at[slot] = now + self.ttl_seconds
+            self._last_used[slot] = now
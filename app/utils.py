@@ -1,15 +1,33 @@
 # app/utils.py
-import json
+import atexit
 import logging
 import os
+import queue
+import re
 from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
 from typing import Optional, Dict, Any
 
+try:
+    import orjson as _json # C decoder, several times faster than stdlib json
+except ImportError: # orjson is optional; fall back to the stdlib decoder
+    import json as _json
+
+try:
+    from dateutil import parser as _dateutil_parser # Installed alongside pandas; only used for unusual date shapes
+except ImportError:
+    _dateutil_parser = None
+
 # Import config from the app package
 from . import config # Use relative import
 
+_log_listener: Optional[QueueListener] = None
+
 def setup_logging():
-    """Sets up basic logging."""
+    """Sets up basic logging. Records are queued and written by a background thread, so callers never block on file/console I/O."""
+    global _log_listener
+    if _log_listener is not None: # Already configured
+        return
     # Ensure log directory exists
     log_dir = os.path.dirname(config.LOG_FILE_PATH)
     if log_dir and not os.path.exists(log_dir):
@@ -20,19 +38,58 @@ def setup_logging():
             # Fallback to no file handler if dir creation fails, or log to current dir.
             # For simplicity, we'll let basicConfig handle it if path is invalid.
 
+    log_queue = queue.Queue(-1) # Unbounded: enqueueing never blocks
+    # The QueueHandler formats each record before enqueueing, so these handlers just write the finished line
+    _log_listener = QueueListener(
+        log_queue,
+        logging.FileHandler(config.LOG_FILE_PATH, mode='a'), # Append mode
+        logging.StreamHandler(), # To console
+        respect_handler_level=True
+    )
+    _log_listener.start()
+    atexit.register(_log_listener.stop) # Flushes records still in the queue on interpreter exit
+
     logging.basicConfig(
         level=getattr(logging, config.LOG_LEVEL, logging.INFO),
         format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        handlers=[
-            logging.FileHandler(config.LOG_FILE_PATH, mode='a'), # Append mode
-            logging.StreamHandler() # To console
-        ]
+        handlers=[QueueHandler(log_queue)]
     )
     # Suppress overly verbose logs from libraries if necessary
     logging.getLogger("chromadb").setLevel(logging.WARNING)
     logging.getLogger("httpx").setLevel(logging.WARNING)
     logging.getLogger("google").setLevel(logging.WARNING) # For google-generativeai library
 
+# Only the characters that can change brace depth or string state; finditer jumps between them in C
+_JSON_SCAN_RE = re.compile(r'[{}"\\]')
+
+def _first_json_object(text: str) -> Optional[str]:
+    """Single forward scan returning the first balanced {...} block, ignoring braces inside string literals."""
+    depth = 0
+    start = -1
+    in_string = False
+    escaped_pos = -1
+    for match in _JSON_SCAN_RE.finditer(text):
+        pos = match.start()
+        if pos == escaped_pos:
+            continue
+        char = match.group()
+        if in_string:
+            if char == "\\":
+                escaped_pos = pos + 1
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = depth > 0 # Quotes in prose before the object don't open a string
+        elif char == "{":
+            if depth == 0:
+                start = pos
+            depth += 1
+        elif char == "}" and depth:
+            depth -= 1
+            if depth == 0:
+                return text[start:pos + 1]
+    return None
+
 def robust_json_parser(llm_output_string: str) -> Optional[Dict[str, Any]]:
     """
     Attempts to parse JSON from a string, handling common LLM output variations.
@@ -42,25 +99,20 @@ def robust_json_parser(llm_output_string: str) -> Optional[Dict[str, Any]]:
     try:
         # Common case: LLM wraps JSON in markdown code blocks
         cleaned_output = llm_output_string.strip()
-        if cleaned_output.startswith("```json"):
-            cleaned_output = cleaned_output[len("```json"):].strip()
+        if cleaned_output.startswith(("```json", "```")):
+            fence_len = 7 if cleaned_output.startswith("```json") else 3
+            cleaned_output = cleaned_output[fence_len:]
             if cleaned_output.endswith("```"):
-                cleaned_output = cleaned_output[:-len("```")].strip()
-        elif cleaned_output.startswith("```") and cleaned_output.endswith("```"):
-             cleaned_output = cleaned_output[3:-3].strip()
-
+                cleaned_output = cleaned_output[:-3]
 
-        # Find the first '{' and last '}'
-        json_start = cleaned_output.find('{')
-        json_end = cleaned_output.rfind('}') + 1
-
-        if json_start != -1 and json_end != -1 and json_start < json_end:
-            json_str = cleaned_output[json_start:json_end]
-            return json.loads(json_str)
+        # First balanced object, so trailing prose or a second object doesn't break decoding
+        json_str = _first_json_object(cleaned_output)
+        if json_str is not None:
+            return _json.loads(json_str)
         else:
             logging.warning(f"Could not find a valid JSON structure in string: {llm_output_string[:200]}...")
             return None
-    except json.JSONDecodeError as e:
+    except ValueError as e: # json.JSONDecodeError and orjson.JSONDecodeError are both ValueErrors
         logging.error(f"JSONDecodeError: {e} while parsing: {llm_output_string[:200]}...")
         return None
     except Exception as e:
@@ -68,6 +120,69 @@ def robust_json_parser(llm_output_string: str) -> Optional[Dict[str, Any]]:
         return None
 
 
+# d.m.Y / Y-m-d / m/d/y ...: groups of digits joined by one repeated separator
+_NUMERIC_DATE_RE = re.compile(r"^(\d{1,4})([./\-])(\d{1,2})\2(\d{1,4})$")
+# Year-first strings (ISO dates/timestamps, 20200102) must not be read with dayfirst=True
+_YEAR_FIRST_RE = re.compile(r"^\d{4}")
+# "May 20, 2007" (group 1 = month) or "20 May 2007" (group 2 = month)
+_ALPHA_DATE_RE = re.compile(r"^(?:([A-Za-z]+)\s+\d{1,2},\s+\d{4}|\d{1,2}\s+([A-Za-z]+)\s+\d{4})$")
+
+# (separator, year position) -> formats to try, in the precedence of the original format list
+_NUMERIC_DATE_FORMATS = {
+    (".", "end"): ("%d.%m.%Y",),
+    (".", "start"): ("%Y.%m.%d",),
+    (".", "short"): ("%d.%m.%y",),
+    ("/", "end"): ("%m/%d/%Y", "%d/%m/%Y"),
+    ("/", "start"): ("%Y/%m/%d",),
+    ("/", "short"): ("%m/%d/%y",),
+    ("-", "end"): ("%d-%m-%Y", "%m-%d-%Y"),
+    ("-", "start"): ("%Y-%m-%d",),
+}
+
+def _candidate_date_formats(date_str: str) -> Optional[tuple]:
+    """Formats that can match date_str, chosen from its shape; None if it has neither known shape."""
+    match = _NUMERIC_DATE_RE.match(date_str)
+    if match:
+        first, separator, _, last = match.groups()
+        if len(first) == 4 and len(last) <= 2:
+            year_position = "start"
+        elif len(first) <= 2 and len(last) == 4:
+            year_position = "end"
+        elif len(first) <= 2 and len(last) == 2:
+            year_position = "short"
+        else:
+            return ()
+        return _NUMERIC_DATE_FORMATS.get((separator, year_position), ())
+
+    match = _ALPHA_DATE_RE.match(date_str)
+    if match:
+        month = match.group(1) or match.group(2)
+        if match.group(1):
+            formats = ("%b %d, %Y", "%B %d, %Y")
+        else:
+            formats = ("%d %b %Y", "%d %B %Y")
+        return formats if len(month) == 3 else formats[::-1] # Abbreviated vs full month name
+    return None
+
+def _parse_date_with_dateutil(date_str: str) -> Optional[str]:
+    """ISO / dateutil fallback; rejects strings missing a day, month or year instead of filling them in."""
+    try:
+        return datetime.fromisoformat(date_str).strftime("%Y-%m-%d") # Python 3.11+ also accepts 'Z' and offsets
+    except ValueError:
+        pass
+    if _dateutil_parser is None:
+        return None
+    # d.m.Y order only applies when the string doesn't open with a 4-digit year
+    order = {"yearfirst": True, "dayfirst": False} if _YEAR_FIRST_RE.match(date_str) else {"dayfirst": True}
+    try:
+        # Parse against two different defaults: if the results differ, a component was borrowed from the default
+        parsed = _dateutil_parser.parse(date_str, default=datetime(2000, 1, 1), **order)
+        if parsed != _dateutil_parser.parse(date_str, default=datetime(2001, 2, 2), **order):
+            return None
+    except (ValueError, OverflowError):
+        return None
+    return parsed.strftime("%Y-%m-%d")
+
 def parse_date_string(date_str: Optional[str]) -> Optional[str]:
     """
     Tries to parse a date string into YYYY-MM-DD format.
@@ -80,14 +195,15 @@ def parse_date_string(date_str: Optional[str]) -> Optional[str]:
     if not date_str: # Empty string after strip
         return None
 
-    common_formats = [
-        "%d.%m.%Y", "%Y-%m-%d", "%m/%d/%Y", "%d/%m/%Y", "%Y/%m/%d",
-        "%Y.%m.%d", "%d-%m-%Y", "%m-%d-%Y",
-        "%b %d, %Y", "%d %b %Y", "%B %d, %Y", "%d %B %Y", # May 20, 2007 or May 20, 2007
-        "%d.%m.%y", "%m/%d/%y", # Short year
-    ]
+    # Classify the shape once and try only the matching format(s) instead of raising through the whole list
+    candidate_formats = _candidate_date_formats(date_str)
+    if candidate_formats is None:
+        parsed = _parse_date_with_dateutil(date_str)
+        if parsed is not None:
+            return parsed
+        candidate_formats = ()
 
-    for fmt in common_formats:
+    for fmt in candidate_formats:
         try:
             dt_obj = datetime.strptime(date_str, fmt)
             # Handle short year (e.g., '07' -> 2007) - strptime does this by default for %y
@@ -99,4 +215,4 @@ def parse_date_string(date_str: Optional[str]) -> Optional[str]:
     # This kind of specific error correction is tricky. LLM should ideally output valid dates.
     # For now, we'll log and return original if no common format matches.
     logging.warning(f"Could not parse date string '{date_str}' into YYYY-MM-DD using common formats. Returning original.")
-    return date_str # Return original string if not parseable by defined formats
\ No newline at end of file
+    return date_str # Return original string if not parseable by defined formats
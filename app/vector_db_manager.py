@@ -1,13 +1,23 @@
 # app/vector_db_manager.py
+import asyncio
+import importlib.util
 import logging
+import re
+import threading
 from typing import List, Optional, Tuple, Dict, Any
-import pandas as pd
+import numpy as np
 import chromadb
 import os
 
 # Import from app package
 from . import config
-from .llm_services import get_gemini_embeddings_batch # Relative import
+from .llm_services import create_embedding_http_client, get_gemini_embeddings_batch, get_gemini_embeddings_batch_async, valid_embedding_mask # Relative import
+from .semantic_cache import SemanticQueryCache
+
+# Characters not allowed in generated document ids (anything but word characters and '-')
+_ID_RE = re.compile(r"[^\w\-]")
+# Rust-backed reader if python-calamine is installed (needs pandas >= 2.2); otherwise pandas' default openpyxl engine
+_XLSX_ENGINE = "calamine" if importlib.util.find_spec("python_calamine") else None
 
 logger = logging.getLogger(__name__)
 import logging
@@ -47,37 +57,99 @@ class VectorDBManager:
             logger.error(f"Failed to initialize ChromaDB persistent client with path '{self.db_path}': {e}", exc_info=True)
             raise
             
+        self._count_cache: Optional[int] = None # Item count, refreshed whenever this instance changes the collection
+        self.generation = 0 # Bumped on every content change; callers caching query results key on it
+        # Serializes populate/reset: a forced repopulate must not delete the collection another population is writing
+        self._populate_lock = threading.Lock()
         self.collection = self._get_or_create_collection()
+        # Near-duplicate queries are answered from memory instead of a Chroma search
+        self._query_cache = SemanticQueryCache(
+            capacity=config.SEMANTIC_CACHE_SIZE,
+            threshold=config.SEMANTIC_CACHE_THRESHOLD,
+            ttl_seconds=config.SEMANTIC_CACHE_TTL_SECONDS
+        ) if config.SEMANTIC_CACHE_SIZE > 0 else None
+        # One keep-alive connection pool for query embeddings instead of a new TLS handshake per request
+        self._http = create_embedding_http_client()
+
+    def close(self):
+        """Releases the pooled HTTP connections; call on application shutdown."""
+        self._http.close()
+
+    def _invalidate_query_cache(self):
+        self.generation += 1
+        self._count_cache = None # Re-read on next use; a count cached mid-change would otherwise stick
+        if self._query_cache is not None:
+            self._query_cache.clear()
 
     # ... (rest of the VectorDBManager class from previous correct version) ...
     def _get_or_create_collection(self) -> chromadb.api.models.Collection.Collection:
         try:
             collection = self.client.get_collection(name=self.collection_name)
-            logger.info(f"Retrieved existing persistent collection: '{self.collection_name}' with {collection.count()} items.")
+            self._count_cache = collection.count()
+            logger.info(f"Retrieved existing persistent collection: '{self.collection_name}' with {self._count_cache} items.")
             return collection
-        except Exception: 
+        except ValueError: # Chroma 0.4 raises ValueError only for "collection does not exist"; anything else propagates
             logger.info(f"Persistent collection '{self.collection_name}' not found at {self.db_path}. Creating new collection.")
-            collection = self.client.create_collection(name=self.collection_name)
-            logger.info(f"Created new persistent collection: '{self.collection_name}'.")
-            return collection
+        # get_or_create rather than create: another worker may have created it since the lookup above.
+        # Only reached for a missing collection, because on an existing one Chroma overwrites the stored
+        # metadata with these values while the index keeps the space/params it was built with.
+        collection = self.client.get_or_create_collection(
+            name=self.collection_name,
+            metadata={
+                "hnsw:space": config.HNSW_SPACE,
+                "hnsw:construction_ef": config.HNSW_CONSTRUCTION_EF,
+                "hnsw:search_ef": config.HNSW_SEARCH_EF,
+                "hnsw:M": config.HNSW_M,
+            }
+        )
+        self._count_cache = collection.count()
+        logger.info(f"Created new persistent collection: '{self.collection_name}'.")
+        return collection
+
+    @property
+    def is_populating(self) -> bool:
+        return self._populate_lock.locked()
 
     def populate_from_xlsx(self, xlsx_path: str = config.XLSX_FILE_PATH, force_repopulate: bool = False):
+        if self.is_populating:
+            logger.info("Another population is in progress; waiting for it to finish.")
+        with self._populate_lock:
+            self._populate_from_xlsx(xlsx_path, force_repopulate)
+
+    def _populate_from_xlsx(self, xlsx_path: str, force_repopulate: bool):
         logger.info(f"Attempting to populate persistent vector DB from: {xlsx_path}")
         if force_repopulate:
             logger.warning(f"Force repopulate: Deleting existing persistent collection '{self.collection_name}' before population.")
             try:
                 self.client.delete_collection(name=self.collection_name)
                 self.collection = self._get_or_create_collection() 
+                self._invalidate_query_cache()
             except Exception as e:
                 logger.error(f"Failed to delete or recreate persistent collection during force repopulate: {e}", exc_info=True)
                 return
 
-        if self.collection.count() > 0 and not force_repopulate:
-            logger.info(f"Persistent collection '{self.collection_name}' already has {self.collection.count()} items. Skipping population. Use force_repopulate=True to override.")
+        if self.has_data and not force_repopulate:
+            logger.info(f"Persistent collection '{self.collection_name}' already has {self.get_collection_count()} items. Skipping population. Use force_repopulate=True to override.")
             return
 
+        # Imported here, not at module level: only ingestion uses pandas, so /extract-only workers never load it
+        import pandas as pd
+
         try:
-            df = pd.read_excel(xlsx_path)
+            # Only the two columns we use; a missing one is reported by the check below
+            # Read straight into string columns so pandas skips per-cell type inference
+            read_kwargs = dict(
+                usecols=lambda column: column in ('Text', 'File Name'),
+                dtype={'Text': str, 'File Name': str}
+            )
+            try:
+                df = pd.read_excel(xlsx_path, engine=_XLSX_ENGINE, **read_kwargs)
+            except ValueError as e:
+                if _XLSX_ENGINE is None:
+                    raise
+                # pandas < 2.2 doesn't know the calamine engine; fall back to the default reader
+                logger.warning(f"Reading {xlsx_path} with engine '{_XLSX_ENGINE}' failed ({e}); retrying with pandas' default engine.")
+                df = pd.read_excel(xlsx_path, **read_kwargs)
         except FileNotFoundError:
             logger.error(f"Excel file not found at: {xlsx_path}")
             return
@@ -89,78 +161,115 @@ class VectorDBManager:
             logger.error("'Text' or 'File Name' column not found in Excel. Cannot populate.")
             return
 
-        texts_to_embed: List[str] = []
-        metadatas: List[Dict[str, Any]] = []
-        ids: List[str] = []
-
-        for index, row in df.iterrows():
-            text_content = str(row['Text'])
-            file_name = str(row['File Name'])
-
-            if not text_content or pd.isna(text_content):
-                logger.warning(f"Skipping row {index} (File: {file_name}) due to empty/NaN text content.")
-                continue
-
-            texts_to_embed.append(text_content)
-            meta = {"file_name": file_name, "original_xlsx_index": str(index)}
-            metadatas.append(meta)
-            safe_file_name_part = "".join(c if c.isalnum() or c in ['-', '_'] else '_' for c in file_name[:30])
-            ids.append(f"doc_{index}_{safe_file_name_part}")
+        # Column-wise instead of iterrows: no per-row Series construction
+        has_text = df['Text'].notna() & (df['Text'].astype(str).str.len() > 0)
+        for index, file_name in df.loc[~has_text, 'File Name'].items():
+            logger.warning(f"Skipping row {index} (File: {file_name}) due to empty/NaN text content.")
+        df = df.loc[has_text]
 
+        texts_to_embed: List[str] = df['Text'].astype(str).tolist()
+        file_names = df['File Name'].fillna("nan").astype(str)
+        row_indices: List[str] = df.index.astype(str).tolist()
+        metadatas: List[Dict[str, Any]] = [
+            {"file_name": file_name, "original_xlsx_index": index}
+            for file_name, index in zip(file_names.tolist(), row_indices)
+        ]
+        # \w matches exactly str.isalnum() characters plus '_', so ids match the old per-character sanitizer
+        safe_file_name_parts = file_names.str[:30].str.replace(_ID_RE, "_", regex=True)
+        ids: List[str] = [f"doc_{index}_{safe_part}" for index, safe_part in zip(row_indices, safe_file_name_parts.tolist())]
 
         if not texts_to_embed:
             logger.info("No valid texts found in Excel to embed.")
             return
 
         logger.info(f"Generating embeddings for {len(texts_to_embed)} documents...")
-        embeddings_list = get_gemini_embeddings_batch(texts_to_embed) 
-
-        valid_texts = []
-        valid_metadatas = []
-        valid_ids = []
-        valid_embeddings = []
-
-        for i, emb_vector in enumerate(embeddings_list):
-            if emb_vector: 
-                valid_texts.append(texts_to_embed[i])
-                valid_metadatas.append(metadatas[i])
-                valid_ids.append(ids[i])
-                valid_embeddings.append(emb_vector)
-            else:
-                logger.warning(f"Failed to generate embedding for document ID: {ids[i]} (text: '{texts_to_embed[i][:50]}...'). Skipping.")
+        try:
+            asyncio.get_running_loop()
+            loop_running = True
+        except RuntimeError:
+            loop_running = False
+        if loop_running:
+            # asyncio.run can't nest inside a running loop, so don't even build the coroutine
+            logger.info("Called from a running event loop; using synchronous embedding.")
+            embeddings = get_gemini_embeddings_batch(texts_to_embed)
+        else:
+            try:
+                # Bulk path: concurrent async requests; fall back to the threaded sync path if it fails outright
+                embeddings = asyncio.run(get_gemini_embeddings_batch_async(texts_to_embed))
+                if not valid_embedding_mask(embeddings).any():
+                    raise RuntimeError("async embedding produced no usable vectors")
+            except Exception as e:
+                logger.warning(f"Async bulk embedding failed ({e}). Falling back to synchronous embedding.")
+                embeddings = get_gemini_embeddings_batch(texts_to_embed)
+        valid_mask = valid_embedding_mask(embeddings)
+
+        for i in np.flatnonzero(~valid_mask):
+            logger.warning(f"Failed to generate embedding for document ID: {ids[i]} (text: '{texts_to_embed[i][:50]}...'). Skipping.")
 
-        if not valid_embeddings:
+        if valid_mask.all():
+            # Common case: use the float32 embedding block and row lists as-is instead of copying them
+            valid_texts, valid_metadatas, valid_ids = texts_to_embed, metadatas, ids
+            valid_embeddings = embeddings
+        else:
+            valid_indices = np.flatnonzero(valid_mask)
+            valid_texts = [texts_to_embed[i] for i in valid_indices]
+            valid_metadatas = [metadatas[i] for i in valid_indices]
+            valid_ids = [ids[i] for i in valid_indices]
+            valid_embeddings = embeddings[valid_mask]
+
+        if not len(valid_embeddings):
             logger.error("No embeddings were successfully generated. DB population failed.")
             return
 
-        try:
-            logger.info(f"Adding {len(valid_embeddings)} items to ChromaDB persistent collection '{self.collection_name}'.")
-            self.collection.add(
-                embeddings=valid_embeddings,
-                documents=valid_texts,
-                metadatas=valid_metadatas,
-                ids=valid_ids
-            )
-            logger.info(f"Successfully added {self.collection.count()} items to persistent collection '{self.collection_name}'.")
-        except Exception as e:
-            logger.error(f"Error adding batch to persistent ChromaDB: {e}", exc_info=True)
-            logger.error(f"Details - Embeddings: {len(valid_embeddings)}, Docs: {len(valid_texts)}, Meta: {len(valid_metadatas)}, IDs: {len(valid_ids)}")
+        batch_size = config.CHROMA_ADD_BATCH_SIZE
+        logger.info(f"Adding {len(valid_embeddings)} items to ChromaDB persistent collection '{self.collection_name}' in batches of {batch_size}.")
+        failed_batches = 0
+        for start in range(0, len(valid_embeddings), batch_size):
+            end = start + batch_size
+            try:
+                self.collection.add(
+                    embeddings=valid_embeddings[start:end].tolist(), # Chroma 0.4 expects plain lists
+                    documents=valid_texts[start:end],
+                    metadatas=valid_metadatas[start:end],
+                    ids=valid_ids[start:end]
+                )
+            except Exception as e:
+                failed_batches += 1
+                logger.error(f"Error adding batch {start}-{min(end, len(valid_ids))} to persistent ChromaDB: {e}", exc_info=True)
+        self._invalidate_query_cache()
+        if failed_batches:
+            logger.error(f"{failed_batches} batch(es) failed to add. Collection '{self.collection_name}' now has {self.get_collection_count()} items.")
+        else:
+            logger.info(f"Successfully added {self.get_collection_count()} items to persistent collection '{self.collection_name}'.")
 
 
-    def query_documents(self, query_text: str, k: int = config.TOP_K_RETRIEVAL) -> List[Dict[str, Any]]:
-        num_items_in_collection = self.collection.count()
+    def query_documents(self, query_text: str, k: int = config.TOP_K_RETRIEVAL, include_text: bool = True) -> List[Dict[str, Any]]:
+        """
+        Returns the k nearest documents as dicts with "id", "metadata", "distance" and, when include_text is True, "text".
+        Pass include_text=False when only metadata is needed so full document texts aren't fetched.
+        """
+        generation = self.generation # Read before querying so results from before a concurrent change are never cached as current
+        num_items_in_collection = self.get_collection_count()
         if num_items_in_collection == 0:
             logger.warning("Querying an empty persistent collection. No results will be found.")
             return []
             
-        logger.debug(f"Querying persistent DB for '{query_text[:50]}...' with k={k}")
-        query_embedding_list = get_gemini_embeddings_batch([query_text])
+        logger.debug("Querying persistent DB for '%s...' with k=%d", query_text[:50], k)
+        query_embeddings = get_gemini_embeddings_batch([query_text], client=self._http)
 
-        if not query_embedding_list or not query_embedding_list[0]:
+        if not valid_embedding_mask(query_embeddings).any():
             logger.error("Failed to generate embedding for query text.")
             return []
 
-        query_embedding = query_embedding_list[0]
+        if self._query_cache is not None:
+            cached_docs = self._query_cache.lookup(query_embeddings[0], k, self.generation)
+            if cached_docs is not None:
+                if not include_text: # Cached results always carry text; return the requested shape
+                    cached_docs = [{key: value for key, value in doc.items() if key != "text"} for doc in cached_docs]
+                logger.info(f"Retrieved {len(cached_docs)} documents for query from semantic query cache.")
+                return cached_docs
+
+        query_embedding = query_embeddings[0].tolist()
         
         actual_k = min(k, num_items_in_collection) 
         if actual_k < k:
@@ -170,19 +279,23 @@ class VectorDBManager:
             results = self.collection.query(
                 query_embeddings=[query_embedding],
                 n_results=actual_k, 
-                include=['documents', 'metadatas', 'distances']
+                include=['documents', 'metadatas', 'distances'] if include_text else ['metadatas', 'distances']
             )
             
             retrieved_docs = []
             if results and results.get('ids') and results['ids'][0]:
                 for i, doc_id in enumerate(results['ids'][0]):
-                    retrieved_docs.append({
+                    doc = {
                         "id": doc_id,
-                        "text": results['documents'][0][i],
                         "metadata": results['metadatas'][0][i] if results.get('metadatas') and results['metadatas'][0] else {},
                         "distance": results['distances'][0][i] if results.get('distances') and results['distances'][0] else None,
-                    })
+                    }
+                    if include_text:
+                        doc["text"] = results['documents'][0][i]
+                    retrieved_docs.append(doc)
                 logger.info(f"Retrieved {len(retrieved_docs)} documents for query from persistent DB.")
+                if self._query_cache is not None and include_text:
+                    self._query_cache.put(query_embeddings[0], k, retrieved_docs, generation)
                 return retrieved_docs
             else:
                 logger.info("No documents found for the query in persistent DB. Query result was empty.")
@@ -192,17 +305,31 @@ class VectorDBManager:
             return []
 
     def get_collection_count(self) -> int:
+        # A zero count is re-checked every time: another worker or process may have populated the shared store since
+        if self._count_cache:
+            return self._count_cache
         try:
-            return self.collection.count()
+            self._count_cache = self.collection.count()
+            return self._count_cache
         except Exception as e:
             logger.error(f"Error getting collection count: {e}", exc_info=True)
             return 0
 
+    @property
+    def has_data(self) -> bool:
+        return self.get_collection_count() > 0
+
     def reset_collection(self):
+        with self._populate_lock:
+            self._reset_collection()
+
+    def _reset_collection(self):
         logger.warning(f"Resetting persistent collection: {self.collection_name} at {self.db_path}. All data will be lost.")
         try:
             self.client.delete_collection(name=self.collection_name)
         except Exception as e:
             logger.warning(f"Could not delete persistent collection '{self.collection_name}' during reset (it might not exist): {e}")
+        self._count_cache = None
         self.collection = self._get_or_create_collection()
+        self._invalidate_query_cache()
         logger.info(f"Persistent collection '{self.collection_name}' has been reset.")
\ No newline at end of file